@@ -0,0 +1,321 @@
+# This is the load and latency benchmark module for the ums_v2 and src apps.
+# Both apps are driven in-process over the ASGI transport against a throwaway
+# SQLite database (or any database given through UMS_DATABASE_URL/UMS_ASYNC_DATABASE_URL),
+# and the results are compared against a stored baseline.
+#
+# Usage (from the repository root):
+#   pip install -r benchmarks/requirements.txt
+#   python benchmarks/run_benchmarks.py                    # run and compare against benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --update-baseline  # run and store the results as the new baseline
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+ADMIN = {"username": "bench_admin", "password": "bench_admin_password", "email": "bench_admin@example.com"}
+STAFF = {"username": "bench_staff", "password": "bench_staff_password", "email": "bench_staff@example.com"}
+SEEDED_USERS = 1000
+
+
+def load_module(name: str, path: str, import_root: str):
+    """Import a main module under a unique name, both apps call theirs `main`."""
+    sys.path.insert(0, import_root)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed_database():
+    """Create the tables and the rows every scenario relies on."""
+    import models
+    from container import SessionLocal, engine
+    from password_pool import pwd_context
+
+    models.Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        db.add_all([
+            models.Roles(role_id=1, role_name="admin"),
+            models.Roles(role_id=2, role_name="staff"),
+            models.Assets(id=1, asset_name="business", is_secret=True),
+            models.Assets(id=2, asset_name="marketing", is_secret=False),
+            models.Permissions(permission_id=1, permission_name="all"),
+            models.Permissions(permission_id=2, permission_name="marketing_read", asset_id=2, is_read=True),
+        ])
+        db.flush()
+        db.add_all([
+            models.RolePermissions(role_id=1, permission_id=1),
+            models.RolePermissions(role_id=2, permission_id=2),
+            models.Users(user_id=1, username=ADMIN["username"], email=ADMIN["email"],
+                         password=pwd_context.hash(ADMIN["password"])),
+            models.Users(user_id=2, username=STAFF["username"], email=STAFF["email"],
+                         password=pwd_context.hash(STAFF["password"])),
+        ])
+        db.add_all([models.Users(user_id=user_id, username=f"seed_{user_id}", email=f"seed_{user_id}@example.com",
+                                 password="not-a-hash", first_name="Seed", last_name=str(user_id))
+                    for user_id in range(3, SEEDED_USERS + 3)])
+        db.flush()
+        db.add_all([models.UserRoles(user_id=1, role_id=1), models.UserRoles(user_id=2, role_id=2)])
+        db.commit()
+    finally:
+        db.close()
+
+
+def percentile(sorted_values: list, share: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(share * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def is_error(response) -> bool:
+    """ums_v2 reports some failures with status 200 and a {"message": "<status code>: <detail>"} body."""
+    if response.status_code >= 400:
+        return True
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        return False
+    body = response.json()
+    message = body.get("message") if isinstance(body, dict) else None
+    if not isinstance(message, str):
+        return False
+    status_code = message.split(":", 1)[0]
+    return status_code.isdigit() and int(status_code) >= 400
+
+
+async def run_scenario(client, request, count: int, concurrency: int) -> dict:
+    """Send `count` requests built by `request(client, index)` from `concurrency` workers."""
+    latencies = []
+    errors = 0
+    next_index = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        for index in next_index:
+            started = time.perf_counter()
+            response = await request(client, index)
+            latencies.append(time.perf_counter() - started)
+            if is_error(response):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def login(client, user: dict) -> str:
+    response = await client.post("/users/v1/login", json={"username": user["username"], "password": user["password"]})
+    return response.json()["access_token"]
+
+
+async def benchmark_ums_v2(app, args) -> dict:
+    import httpx
+    from container import async_engine
+
+    results = {}
+    await app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            admin_token = await login(client, ADMIN)
+            staff_token = await login(client, STAFF)
+            scenarios = {
+                "ums_v2.register": (args.hash_requests, lambda c, i: c.post(
+                    "/users/v1/register",
+                    json={"username": f"bench_user_{i}", "password": "password", "email": f"bench_user_{i}@example.com"})),
+                "ums_v2.login": (args.hash_requests, lambda c, i: c.post(
+                    "/users/v1/login", json={"username": STAFF["username"], "password": STAFF["password"]})),
+                "ums_v2.assets_business": (args.requests, lambda c, i: c.get(
+                    "/assets/v1/business", headers=bearer(admin_token))),
+                "ums_v2.assets_marketing": (args.requests, lambda c, i: c.get(
+                    "/assets/v1/marketing", headers=bearer(staff_token))),
+                "ums_v2.assign_role": (args.requests, lambda c, i: c.post(
+                    "/assign_role", json={"user_id": 3 + i % SEEDED_USERS, "role_id": 2},
+                    headers=bearer(admin_token))),
+            }
+            for name, (count, request) in scenarios.items():
+                if args.scenario and args.scenario not in name:
+                    continue
+                results[name] = await run_scenario(client, request, count, args.concurrency)
+                print(f"{name}: {results[name]}")
+    finally:
+        await app.router.shutdown()
+        # Pooled aiosqlite connections run on non-daemon threads that would keep the process alive.
+        await async_engine.dispose()
+    return results
+
+
+async def benchmark_src(app, args) -> dict:
+    from utils.container import async_engine
+
+    results = {}
+    await app.router.startup()
+    try:
+        await run_src_scenarios(app, args, results)
+    finally:
+        await app.router.shutdown()
+        await async_engine.dispose()
+    return results
+
+
+async def run_src_scenarios(app, args, results: dict):
+    import httpx
+    from utils.constants import USER_SEARCH_MAX_LIMIT
+    from utils.container import async_engine
+    from utils.query_budget import QueryBudgetExceeded, query_budget
+    from utils.user_search import search_index
+
+    # The search index loads in the background after startup.
+    for _ in range(600):
+        if search_index.ready:
+            break
+        await asyncio.sleep(0.05)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        def user_body(prefix, i):
+            return {"username": f"{prefix}_{i}", "password_hash": "hash", "email": f"{prefix}_{i}@example.com",
+                    "first_name": "Bench", "last_name": str(i)}
+
+        # name -> (requests, request builder, SQL statements one request may run)
+        scenarios = {
+            "src.create_user": (args.requests, lambda c, i: c.post(
+                "/users/create", json=user_body("src_user", i)), 1),
+            "src.get_user": (args.requests, lambda c, i: c.get(f"/users/{3 + i % SEEDED_USERS}"), 1),
+            "src.update_user": (args.requests, lambda c, i: c.put(
+                f"/users/{3 + i % SEEDED_USERS}", json=user_body("src_updated", i % SEEDED_USERS)), 1),
+            "src.assign_role": (args.requests, lambda c, i: c.post(
+                "/assign_role", json={"user_id": 3 + i % SEEDED_USERS, "role_id": 1}), 2),
+            "src.search_users": (args.requests, lambda c, i: c.get(
+                "/users/search", params={"q": f"src user {i % 10}"}), 0),
+            # A full page of seeded users from memory, the time goes into building and serializing the response.
+            "src.search_users_page": (args.requests, lambda c, i: c.get(
+                "/users/search", params={"q": "seed", "limit": USER_SEARCH_MAX_LIMIT}), 0),
+            "src.export_users": (max(1, args.requests // 10), lambda c, i: c.get(
+                "/users/export", params={"format": "csv" if i % 2 else "ndjson", "gzip": i % 4 < 2}), 1),
+            "src.delete_user": (args.requests, lambda c, i: c.delete(f"/users/{3 + i % SEEDED_USERS}"), 1),
+        }
+        for name, (count, request, budget) in scenarios.items():
+            if args.scenario and args.scenario not in name:
+                continue
+            # One request on its own first, so its statements are not mixed with concurrent ones.
+            exceeded = None
+            try:
+                with query_budget(async_engine.sync_engine, budget, name) as statements:
+                    await request(client, count)
+            except QueryBudgetExceeded as error:
+                exceeded = error
+            results[name] = await run_scenario(client, request, count, args.concurrency)
+            results[name].update({"sql_statements": len(statements), "sql_budget": budget})
+            print(f"{name}: {results[name]}")
+            if exceeded:
+                print(exceeded)
+
+
+def over_budget(results: dict) -> list:
+    """Return a description of every scenario running more SQL per request than its budget."""
+    return [f"{name}: {result['sql_statements']} SQL statements per request > budget {result['sql_budget']}"
+            for name, result in results.items() if result.get("sql_statements", 0) > result.get("sql_budget", 0)]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return a description of every scenario that got slower than the baseline allows."""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get("scenarios", {}).get(name)
+        if not expected:
+            continue
+        if result["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms > baseline {expected['p95_ms']}ms")
+        if result["throughput_rps"] < expected["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['throughput_rps']} req/s < baseline {expected['throughput_rps']} req/s")
+        if result["errors"] > expected["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors > baseline {expected['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ums_v2 and src apps in-process.")
+    parser.add_argument("--app", choices=("all", "ums_v2", "src"), default="all")
+    parser.add_argument("--scenario", help="Only run scenarios whose name contains this text.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario.")
+    parser.add_argument("--hash-requests", type=int, default=40,
+                        help="Requests per password hashing scenario (register, login).")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the results as JSON.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed relative slowdown against the baseline before failing.")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+
+    workdir = tempfile.mkdtemp(prefix="ums_bench_")
+    os.chdir(workdir)  # Keeps the app logs of the run out of the repository.
+    database = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("UMS_DATABASE_URL", f"sqlite:///{database}")
+    os.environ.setdefault("UMS_ASYNC_DATABASE_URL", f"sqlite+aiosqlite:///{database}")
+    # The login scenario signs the same user in from one client, far beyond the credential stuffing limits.
+    os.environ.setdefault("UMS_LOGIN_USERNAME_RATE", "1000000/1")
+    os.environ.setdefault("UMS_LOGIN_IP_RATE", "1000000/1")
+
+    ums_v2 = load_module("ums_v2_main", os.path.join(REPO_ROOT, "ums_v2", "main.py"), os.path.join(REPO_ROOT, "ums_v2"))
+    src = load_module("src_main", os.path.join(REPO_ROOT, "src", "main.py"), os.path.join(REPO_ROOT, "src"))
+    seed_database()
+
+    results = {}
+    if args.app in ("all", "ums_v2"):
+        results.update(asyncio.run(benchmark_ums_v2(ums_v2.app, args)))
+    if args.app in ("all", "src"):
+        results.update(asyncio.run(benchmark_src(src.app, args)))
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "database": os.environ["UMS_ASYNC_DATABASE_URL"].split(":")[0],
+        "concurrency": args.concurrency,
+        "scenarios": results,
+    }
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"Results written to {output}")
+
+    # Query budgets do not depend on the machine, so they are enforced with or without a baseline.
+    regressions = over_budget(results)
+    if args.update_baseline and not regressions:
+        with open(baseline_path, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline updated: {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print(f"No baseline found at {baseline_path}, run with --update-baseline to create one.")
+    elif not args.update_baseline:
+        with open(baseline_path) as baseline_file:
+            regressions += compare(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -79,3 +79,57 @@ CREATE TABLE role_permissions (
     created_by VARCHAR(100) DEFAULT 'system',
     updated_by VARCHAR(100) DEFAULT 'system'
 );
+
+-- Create Sessions table holding the hashed refresh tokens
+CREATE TABLE sessions (
+    session_id SERIAL PRIMARY KEY,
+    user_id INT NOT NULL REFERENCES users(user_id),
+    refresh_token_hash VARCHAR(64) NOT NULL UNIQUE,
+    previous_token_hash VARCHAR(64),
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_by VARCHAR(100) DEFAULT 'system',
+    updated_by VARCHAR(100) DEFAULT 'system'
+);
+
+CREATE INDEX idx_sessions_user on sessions(user_id);
+CREATE INDEX idx_sessions_previous_token on sessions(previous_token_hash);
+CREATE INDEX idx_sessions_expires on sessions(expires_at);
+
+CREATE TABLE revoked_tokens (
+    jti VARCHAR(64) PRIMARY KEY,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_by VARCHAR(100) DEFAULT 'system',
+    updated_by VARCHAR(100) DEFAULT 'system'
+);
+
+CREATE INDEX idx_revoked_tokens_revoked on revoked_tokens(revoked_at);
+CREATE INDEX idx_revoked_tokens_expires on revoked_tokens(expires_at);
+
+-- Keep updated_at current on every update, also the ones made outside the apps (psql, migrations, other
+-- services). The RBAC index and the user search index only pick up rows whose updated_at moved past what
+-- they have seen. Deleted rows leave nothing to pick up, they are only seen by the periodic full reload.
+CREATE OR REPLACE FUNCTION set_updated_at() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = CURRENT_TIMESTAMP;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_users_updated_at BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE TRIGGER trg_roles_updated_at BEFORE UPDATE ON roles
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE TRIGGER trg_user_roles_updated_at BEFORE UPDATE ON user_roles
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE TRIGGER trg_assets_updated_at BEFORE UPDATE ON assets
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE TRIGGER trg_permissions_updated_at BEFORE UPDATE ON permissions
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+CREATE TRIGGER trg_role_permissions_updated_at BEFORE UPDATE ON role_permissions
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
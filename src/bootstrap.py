@@ -0,0 +1,85 @@
+# This is the superuser bootstrap module.
+# Seeds the 'all' permission, the admin role, their relation and the superuser with its admin role
+# in one transaction. Every row is an upsert, so running it again (or from several workers at once)
+# changes nothing. Run it once per deployment, before starting the server:
+#
+#   UMS_SUPERUSER_USERNAME=admin UMS_SUPERUSER_PASSWORD=... python bootstrap.py   (from the src directory)
+
+import argparse
+import logging
+import sys
+from logging import getLogger
+
+from passlib.context import CryptContext
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from utils.constants import BOOTSTRAP_LOCK_ID, SUPERUSER_EMAIL, SUPERUSER_PASSWORD, SUPERUSER_USERNAME
+from utils.container import SessionLocal, upsert_insert
+from utils.models import Permissions, RolePermissions, Roles, UserRoles, Users
+
+logger = getLogger(__name__)
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _upsert_id(db: Session, model, key_column, values: dict):
+    """Insert the row unless its unique key exists and return its id either way, in one statement."""
+    # A no-op update of the key makes RETURNING yield the existing row as well.
+    return db.scalar(
+        upsert_insert(model).values(**values).
+        on_conflict_do_update(index_elements=[key_column], set_={key_column.name: values[key_column.name]}).
+        returning(*model.__table__.primary_key.columns))
+
+
+def bootstrap(db: Session, username: str, password: str, email: str = None) -> int:
+    """Seed the superuser data in one transaction and return the superuser's user_id."""
+    if db.get_bind().dialect.name == "postgresql":
+        # Released at commit, concurrent bootstraps wait here instead of racing on the upserts.
+        db.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": BOOTSTRAP_LOCK_ID})
+    permission_id = _upsert_id(db, Permissions, Permissions.permission_name, {"permission_name": "all"})
+    role_id = _upsert_id(db, Roles, Roles.role_name, {"role_name": "admin"})
+    db.execute(upsert_insert(RolePermissions).values(role_id=role_id, permission_id=permission_id).
+               on_conflict_do_nothing())
+    user_id = db.scalar(select(Users.user_id).filter(Users.username == username))
+    if user_id is None:
+        # Hashing is the slow part, so it only happens when the superuser is really created.
+        user_id = _upsert_id(db, Users, Users.username, {
+            "username": username, "password_hash": pwd_context.hash(password), "email": email, "status": "active"})
+        logger.info(f"Super user {username} created.")
+    else:
+        logger.info(f"Super user {username} exists, keeping its password.")
+    db.execute(upsert_insert(UserRoles).values(user_id=user_id, role_id=role_id).on_conflict_do_nothing())
+    db.commit()
+    return user_id
+
+
+def bootstrap_from_env() -> bool:
+    """Bootstrap the superuser from UMS_SUPERUSER_* if they are set, return whether it ran."""
+    if not SUPERUSER_USERNAME or not SUPERUSER_PASSWORD:
+        logger.info("UMS_SUPERUSER_USERNAME/UMS_SUPERUSER_PASSWORD not set, skipping the super user bootstrap.")
+        return False
+    with SessionLocal() as db:
+        bootstrap(db, SUPERUSER_USERNAME, SUPERUSER_PASSWORD, SUPERUSER_EMAIL)
+    return True
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Create the superuser, its admin role and the 'all' permission.")
+    parser.add_argument("--username", default=SUPERUSER_USERNAME, help="Defaults to UMS_SUPERUSER_USERNAME.")
+    parser.add_argument("--email", default=SUPERUSER_EMAIL, help="Defaults to UMS_SUPERUSER_EMAIL.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    # The password is only read from the environment, so it does not end up in the process list.
+    if not args.username or not SUPERUSER_PASSWORD:
+        logger.error("Username and password are required, set UMS_SUPERUSER_USERNAME and UMS_SUPERUSER_PASSWORD.")
+        return 1
+    with SessionLocal() as db:
+        user_id = bootstrap(db, args.username, SUPERUSER_PASSWORD, args.email)
+    logger.info(f"Bootstrap done, super user {args.username} has user_id {user_id} and the admin role.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+# This is the bulk user export script.
+# Writes every user with their roles and asset wise permissions as NDJSON or CSV, streamed from the
+# database in batches, so it runs in constant memory whatever the number of users:
+#
+#   python export_users.py --format csv --gzip --output users.csv.gz   (from the src directory)
+
+import argparse
+import logging
+import sys
+from logging import getLogger
+
+from utils.export import EXPORT_FORMATS, write_export
+
+logger = getLogger(__name__)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Export users with their roles and asset wise permissions.")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson", dest="export_format")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip.")
+    parser.add_argument("--status", help="Only export users with this status, e.g. active. Defaults to all users.")
+    parser.add_argument("--output", help="File to write, defaults to standard output.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.output:
+        with open(args.output, "wb") as output:
+            users = write_export(output, args.export_format, args.gzip, args.status)
+    else:
+        users = write_export(sys.stdout.buffer, args.export_format, args.gzip, args.status)
+        sys.stdout.buffer.flush()
+    logger.info(f"Exported {users} users to {args.output or 'standard output'}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
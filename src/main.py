@@ -1,144 +1,169 @@
 # This is the main api entry module.
 
-from fastapi import FastAPI, status, Depends, HTTPException
+import asyncio
+import orjson
+from fastapi import FastAPI, status, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from logging import getLogger
-from sqlalchemy.orm import Session
-
-from utils.container import get_db
-from utils.models import Users, Permissions, RolePermissions, Roles, UserRoles
-from utils.schemas import CreateUser, AssignUserRole
-
-
-app = FastAPI()
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bootstrap import bootstrap_from_env
+from utils.constants import BOOTSTRAP_ON_STARTUP, LIST_USERS_DEFAULT_LIMIT, LIST_USERS_MAX_LIMIT, \
+    READ_YOUR_WRITES_COOKIE, READ_YOUR_WRITES_SECONDS, USER_SEARCH_DEFAULT_LIMIT, USER_SEARCH_MAX_LIMIT
+from utils.container import get_read_db
+from utils.export import EXPORT_FORMATS, stream_export
+from utils.models import Assets, Users, Permissions, RolePermissions, Roles, UserRoles
+from utils.permissions import merge_permission
+from utils.repository import UserRepository, get_read_repository, get_repository
+from utils.schemas import CreateUser, AssignUserRole, MessageResponse, RoleAssignmentResponse, UserCreatedResponse, \
+    UserDetailsResponse, UserMessageResponse, UserPage, UserSearchResponse, UserSearchResult
+from utils.shared import ReadYourWritesMiddleware, fast_response
+from utils.user_search import USER_COLUMNS, search_index, start_search_refresher
+
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(ReadYourWritesMiddleware, cookie_name=READ_YOUR_WRITES_COOKIE,
+                   sticky_seconds=READ_YOUR_WRITES_SECONDS)
 logger = getLogger(__name__)
 
 
 @app.on_event("startup")
 async def startup_event():
     """This is the server start up event function.
-    In this function, we will do following if needed. It depends on the end user's response.
-        1. Create superuser permission if not exists.
-        2. Create superuser role if not exists.
-        3. Create superuser permission and role relation if not exists.
-        4. Asks for Username and Password of the superuser and create a superuser.
-        5. Assign the superuser role to newly created superuser.
+    Server start never waits for input. The superuser is seeded by running bootstrap.py once per deployment,
+    or here when UMS_BOOTSTRAP_ON_STARTUP is set, from the UMS_SUPERUSER_* environment variables.
     """
     logger.info("Starting the server...")
-    create_super_user = input("Create a new super user[y/n]?[n]: ")
-    if create_super_user.lower() == 'y':
-        db = next(get_db())
-        logger.info("Fetching 'all' permission...")
-        all_permissions = db.query(Permissions).filter(Permissions.permission_name == "all").first()
-        if all_permissions is None:
-            logger.info("'all' permission not found.\nCreating 'all' permission...")
-            all_permissions = Permissions(**{"permission_name": "all"})
-            db.add(all_permissions)
-            db.commit()
-            db.refresh(all_permissions)
-            logger.info("'all' permission created.")
-        else:
-            logger.info("'all' permission found.")
-        logger.info("Fetching admin role...")
-        admin_role = db.query(Roles).filter(Roles.role_name == "admin").first()
-        if admin_role is None:
-            logger.info("admin role not found.\n Creating admin role...")
-            admin_role = Roles(**{"role_name": "admin"})
-            db.add(admin_role)
-            db.commit()
-            db.refresh(admin_role)
-            logger.info("admin role created.")
-        else:
-            logger.info("admin role found.")
-        logger.info("Fetching role permission...")
-        role_permission = db.query(RolePermissions).\
-            filter(RolePermissions.role_id == admin_role.role_id).\
-            filter(RolePermissions.permission_id == all_permissions.permission_id).first()
-        if role_permission is None:
-            logger.info("Role permission not found.\nCreating new role permission...")
-            role_permission = RolePermissions(
-                **{"role_id": admin_role.role_id, "permission_id": all_permissions.permission_id})
-            db.add(role_permission)
-            db.commit()
-            db.refresh(role_permission)
-            logger.info("Role permission created successfully.")
-        else:
-            logger.info("Role permission found.")
-        logger.info("Creating super user.")
-        user_name = input("Enter username: ")
-        if not user_name:
-            logger.error("Username is required.")
-            exit(1)
-        password = input("Enter password: ")
-        if not password:
-            logger.error("Password is required.")
-            exit(1)
-        new_user = db.query(Users).filter(Users.username == user_name).filter(Users.status == "active").first()
-        if new_user:
-            logger.error(f"User {user_name} exists.")
-            exit(0)
-        new_user = Users(**{"username": user_name, "password_hash": password, "status": "active"})
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        logger.info("New super user created...")
-        logger.info("Applying the role to super user...")
-        role_user = UserRoles(**{"user_id": new_user.user_id, "role_id": admin_role.role_id})
-        db.add(role_user)
-        db.commit()
-        db.refresh(role_user)
-        logger.info("Role assigned to super user. ")
+    if BOOTSTRAP_ON_STARTUP:
+        # The bootstrap is idempotent and serialized, so every worker may run it.
+        await asyncio.to_thread(bootstrap_from_env)
     else:
-        logger.info("Moving forward without creating super user.")
-
+        logger.info("Moving forward without the super user bootstrap.")
+    app.state.search_refresher = start_search_refresher()
     logger.info("Good to go...\nStarting the server...")
 
 
-@app.get("/healthcheck")
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.search_refresher.set()
+
+
+@app.get("/healthcheck", response_model=MessageResponse)
 async def healthcheck():
     """Healthcheck API. useful for checking server health after deployment."""
     return {"message": "Server Health is good!"}
 
 
-@app.post("/users/create", status_code=status.HTTP_201_CREATED)
-async def create_user(user_request: CreateUser, db: Session = Depends(get_db)):
+@app.post("/users/create", status_code=status.HTTP_201_CREATED, response_model=UserCreatedResponse)
+async def create_user(user_request: CreateUser, repository: UserRepository = Depends(get_repository)):
     """User creation API."""
     try:
         logger.info("Started creating the new user.")
-        new_user = Users(**user_request.dict())
-        db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
-        logger.info(f"New user created successfully: {new_user.username}")
-        return {
-            "user_name": user_request.username,
-            "message": f"User {user_request.username} created successfully!"
-        }
-    except Exception as error:
-        logger.error(f"Failure while creating a new user: {user_request.username}: {error}")
-        if "already exists" in str(error):
+        new_user = await repository.create_user(user_request.dict())
+        if new_user is None:
+            logger.error(f"User {user_request.username} already exists.")
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"User {user_request.username} already exists!"
             )
+        await repository.db.commit()
+        search_index.upsert({column: getattr(new_user, column) for column in USER_COLUMNS})
+        logger.info(f"New user created successfully: {new_user.username}")
+        return fast_response(UserCreatedResponse, status.HTTP_201_CREATED, user_name=user_request.username,
+                             message=f"User {user_request.username} created successfully!")
+    except HTTPException:
+        raise
+    except Exception as error:
+        logger.error(f"Failure while creating a new user: {user_request.username}: {error}")
 
 
-@app.put("/users/{user_id}")
-async def update_user(user_id: int, user_request: CreateUser, db: Session = Depends(get_db)):
+@app.get("/users", response_model=UserPage)
+async def list_users(status_filter: str = Query("active", alias="status"), after_id: int = 0,
+                     limit: int = Query(LIST_USERS_DEFAULT_LIMIT, ge=1, le=LIST_USERS_MAX_LIMIT),
+                     db: AsyncSession = Depends(get_read_db)):
+    """List API for users with their roles and asset wise permissions.
+    Pages are keyed on user_id: pass the returned next_after_id as after_id to fetch the next page.
+    """
+    try:
+        logger.info(f"Listing {status_filter} users after {after_id}.")
+        users = (await db.execute(
+            select(Users.user_id, Users.username, Users.email, Users.first_name, Users.last_name, Users.status).
+            filter(Users.status == status_filter).filter(Users.user_id > after_id).
+            order_by(Users.user_id).limit(limit))).all()
+        access = {user.user_id: {"roles": [], "permissions": {}} for user in users}
+        if users:
+            logger.info(f"Fetching roles and permissions for {len(users)} users.")
+            rows = (await db.execute(
+                select(UserRoles.user_id, Roles.role_name, Assets.asset_name, Permissions.permission_id,
+                       Permissions.asset_id, Permissions.is_read, Permissions.is_create, Permissions.is_update,
+                       Permissions.is_delete).
+                join(Roles, Roles.role_id == UserRoles.role_id).
+                outerjoin(RolePermissions, RolePermissions.role_id == Roles.role_id).
+                outerjoin(Permissions, Permissions.permission_id == RolePermissions.permission_id).
+                outerjoin(Assets, Assets.id == Permissions.asset_id).
+                filter(UserRoles.user_id.in_(access.keys())))).all()
+            for row in rows:
+                user_access = access[row.user_id]
+                if row.role_name not in user_access["roles"]:
+                    user_access["roles"].append(row.role_name)
+                if row.permission_id is not None:
+                    merge_permission(user_access["permissions"], row, row.asset_name)
+    except Exception as error:
+        logger.error(f"Error in listing users: {error}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+    def encode_page():
+        yield b'{"users":['
+        for index, user in enumerate(users):
+            yield (b"," if index else b"") + orjson.dumps({**user._asdict(), **access[user.user_id]})
+        next_after_id = users[-1].user_id if len(users) == limit else None
+        yield b'],"next_after_id":' + orjson.dumps(next_after_id) + b"}"
+
+    return StreamingResponse(encode_page(), media_type="application/json")
+
+
+@app.get("/users/search", response_model=UserSearchResponse)
+async def search_users(q: str, status_filter: str = Query("active", alias="status"),
+                       limit: int = Query(USER_SEARCH_DEFAULT_LIMIT, ge=1, le=USER_SEARCH_MAX_LIMIT)):
+    """Search API for users by the start of any word of their username, email, first or last name.
+    Served from the in-memory index without touching the database, best matches first.
+    """
+    if not search_index.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="User search index is still loading.")
+    users = search_index.search(q, status_filter, limit)
+    return fast_response(UserSearchResponse, users=[UserSearchResult.model_construct(**user) for user in users])
+
+
+@app.get("/users/export")
+async def export_users(export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+                       gzip: bool = False, status_filter: str = Query(None, alias="status")):
+    """Bulk export API of every user with their roles and asset wise permissions, as NDJSON or CSV.
+    The file is streamed from a server-side cursor while it is read, pass gzip=true to get it compressed.
+    """
+    logger.info(f"Exporting {status_filter or 'all'} users as {export_format}.")
+    filename = f"users.{export_format}" + (".gz" if gzip else "")
+    return StreamingResponse(stream_export(export_format, gzip, status_filter),
+                             media_type="application/gzip" if gzip else EXPORT_FORMATS[export_format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.put("/users/{user_id}", response_model=UserMessageResponse)
+async def update_user(user_id: int, user_request: CreateUser, repository: UserRepository = Depends(get_repository)):
     """Update API for the existing user."""
     try:
         logger.info(f"Updating the user: {user_id}")
-        user = db.query(Users).filter(Users.user_id == user_id).filter(Users.status == "active")
-        if user.first() is None:
+        user = await repository.update_active_user(user_id, user_request.dict())
+        if user is None:
             logger.error(f"Error: No active user found with {user_id}.")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
-        user.update(user_request.dict(), synchronize_session=False)
-        db.commit()
+        await repository.db.commit()
+        search_index.upsert({column: getattr(user, column) for column in USER_COLUMNS})
         logger.info(f"User details updated successfully! {user_id}")
-        return {
-            "user_id": user_id,
-            "message": f"User deleted successfully!"
-        }
+        return fast_response(UserMessageResponse, user_id=user_id, message=f"User deleted successfully!")
     except HTTPException:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
@@ -148,24 +173,18 @@ async def update_user(user_id: int, user_request: CreateUser, db: Session = Depe
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
 
 
-@app.get("/users/{user_id}")
-async def get_user(user_id: int, db: Session = Depends(get_db)):
+@app.get("/users/{user_id}", response_model=UserDetailsResponse)
+async def get_user(user_id: int, repository: UserRepository = Depends(get_read_repository)):
     """Get API for the existing user."""
     try:
         logger.info(f"Fetching data for {user_id}.")
-        user = db.query(Users).filter(Users.user_id == user_id).filter(Users.status == "active")
-        if user.first() is None:
+        user_data = await repository.get_active_user_details(user_id)
+        if user_data is None:
             logger.error(f"Error: No active user found with {user_id}.")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
-        user_data = user.first()
-        logger.info("Masking user password.")
-        user_data.password_hash = "******"
-        return {
-            "user_id": user_id,
-            "message": f"User found successfully!",
-            "user_details": user.first()
-        }
+        return fast_response(UserDetailsResponse, user_id=user_id, message=f"User found successfully!",
+                             user_details=user_data)
     except HTTPException:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
@@ -175,24 +194,19 @@ async def get_user(user_id: int, db: Session = Depends(get_db)):
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
 
 
-@app.delete("/users/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(get_db)):
+@app.delete("/users/{user_id}", response_model=UserMessageResponse)
+async def delete_user(user_id: int, repository: UserRepository = Depends(get_repository)):
     """Delete API for the existing user. It will soft-delete the user."""
     try:
-        logger.info(f"Fetching data for {user_id} to delete.")
-        user = db.query(Users).filter(Users.user_id == user_id)
-        if user.first() is None:
+        logger.info(f"Setting the status as inactive for the user {user_id}")
+        if not await repository.deactivate_user(user_id):
             logger.error(f"Error: No active user found with {user_id}.")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
-        logger.info(f"Setting the status as inactive for the user {user_id}")
-        user.update({"status": "inactive"}, synchronize_session=False)
-        db.commit()
+        await repository.db.commit()
+        search_index.set_status(user_id, "inactive")
         logger.info(f"User {user_id} soft deleted successfully!")
-        return {
-            "user_id": user_id,
-            "message": f"User deleted successfully!"
-        }
+        return fast_response(UserMessageResponse, user_id=user_id, message=f"User deleted successfully!")
     except HTTPException as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
@@ -202,42 +216,26 @@ async def delete_user(user_id: int, db: Session = Depends(get_db)):
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
 
 
-@app.post("/assign_role")
-async def role_assignment(user_request: AssignUserRole, db: Session = Depends(get_db)):
+@app.post("/assign_role", response_model=RoleAssignmentResponse)
+async def role_assignment(user_request: AssignUserRole, repository: UserRepository = Depends(get_repository)):
     """This API will assign the provided role to provided user."""
     try:
-        logger.info(f"Fetching data for user {user_request.user_id}.")
-        user = db.query(Users).filter(Users.user_id == user_request.user_id).first()
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
-        logger.info(f"Fetching data for role {user_request.role_id}.")
-        role = db.query(Roles).filter(Roles.role_id == user_request.role_id).first()
-        if not role:
+        logger.info(f"Assigning role {user_request.role_id} to user {user_request.user_id}.")
+        assignment = await repository.assign_role(user_request.user_id, user_request.role_id)
+        if assignment is None:
+            missing = "User" if not await repository.user_exists(user_request.user_id) else "Role"
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail=f"Role not found!")
-        logger.info(f"Checking if role {role.role_name} to user {user.username} already assigned.")
-        user_role = db.query(UserRoles).\
-            filter(UserRoles.user_id == user_request.user_id).\
-            filter(UserRoles.role_id == user_request.role_id).first()
-        if user_role:
-            logger.info(f"Role {role.role_name} already assigned to user {user.username}")
-            return {
-                "user_name": user.username,
-                "role": role.role_name,
-                "message": f"Role already has been assigned!"
-            }
-        logger.info(f"Assigning Role {role.role_name} to user {user.username}.")
-        user_role = UserRoles(**{"user_id": user.user_id, "role_id": role.role_id})
-        db.add(user_role)
-        db.commit()
-        db.refresh(user_role)
-        logger.info(f"Role {role.role_name} assigned to user {user.username}")
-        return {
-            "user_name": user.username,
-            "role": role.role_name,
-            "message": f"Role {role.role_name} has been assigned to the user {user.username} successfully!"
-        }
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"{missing} not found!")
+        username, role_name, assigned = assignment
+        if not assigned:
+            logger.info(f"Role {role_name} already assigned to user {username}")
+            return fast_response(RoleAssignmentResponse, user_name=username, role=role_name,
+                                 message=f"Role already has been assigned!")
+        await repository.db.commit()
+        logger.info(f"Role {role_name} assigned to user {username}")
+        return fast_response(
+            RoleAssignmentResponse, user_name=username, role=role_name,
+            message=f"Role {role_name} has been assigned to the user {username} successfully!")
     except HTTPException as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
@@ -1,17 +1,36 @@
 # This is the database engine creation and management module.
 
 from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from .constants import DB_HOST, DB_NAME, DB_PORT, DB_PASSWORD, DB_USERNAME
+from .constants import DB_HOST, DB_NAME, DB_PORT, DB_PASSWORD, DB_USERNAME, DATABASE_URL, ASYNC_DATABASE_URL, \
+    ASYNC_REPLICA_URLS, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_REPLICA_MAX_OVERFLOW, DB_REPLICA_POOL_SIZE, \
+    REPLICA_RETRY_SECONDS
+from .shared import PrimarySession, ReadRouting
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+SQLALCHEMY_DATABASE_URL = DATABASE_URL or f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_SQLALCHEMY_DATABASE_URL = ASYNC_DATABASE_URL or \
+    f"postgresql+asyncpg://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# The sync engine is kept for scripts and background threads, the api uses the async engine.
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
+replica_engines = [
+    create_async_engine(url, pool_size=DB_REPLICA_POOL_SIZE, max_overflow=DB_REPLICA_MAX_OVERFLOW)
+    for url in ASYNC_REPLICA_URLS
+]
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine,
+                                       sync_session_class=PrimarySession)
+
 Base = declarative_base()
 
 
@@ -21,3 +40,24 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def upsert_insert(model):
+    """INSERT supporting ON CONFLICT for the configured dialect (Postgres, or the SQLite stand-in)."""
+    if async_engine.dialect.name == "sqlite":
+        return sqlite_insert(model)
+    return postgresql_insert(model)
+
+
+read_routing = ReadRouting(async_engine, AsyncSessionLocal, replica_engines, REPLICA_RETRY_SECONDS)
+read_session = read_routing.read_session
+
+
+async def get_read_db():
+    async with read_session() as db:
+        yield db
@@ -0,0 +1,140 @@
+# This is the bulk user export module.
+# Every user with its roles and effective asset permissions is streamed as NDJSON or CSV from one query
+# read through a server-side cursor in batches of EXPORT_BATCH_ROWS, so memory does not grow with the
+# number of users. Encoded rows are written out in chunks of about EXPORT_CHUNK_BYTES, optionally gzipped.
+# On Postgres the query runs in a read-only REPEATABLE READ transaction: the export sees one snapshot,
+# and takes no lock a writer waits for.
+
+import csv
+import io
+import zlib
+from logging import getLogger
+
+import orjson
+from sqlalchemy import select
+
+from .constants import EXPORT_BATCH_ROWS, EXPORT_CHUNK_BYTES
+from .container import SessionLocal, read_session
+from .models import Assets, Permissions, RolePermissions, Roles, UserRoles, Users
+from .permissions import merge_permission
+
+logger = getLogger(__name__)
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+USER_COLUMNS = ("user_id", "username", "email", "first_name", "last_name", "status", "created_at", "updated_at")
+CSV_COLUMNS = USER_COLUMNS + ("roles", "permissions")
+
+
+def export_query(status: str = None):
+    """One row per user, role and permission, ordered by user so each user's rows are adjacent."""
+    query = select(*[getattr(Users, column) for column in USER_COLUMNS], Roles.role_name, Assets.asset_name,
+                   Permissions.permission_id, Permissions.asset_id, Permissions.is_read, Permissions.is_create,
+                   Permissions.is_update, Permissions.is_delete).\
+        outerjoin(UserRoles, UserRoles.user_id == Users.user_id).\
+        outerjoin(Roles, Roles.role_id == UserRoles.role_id).\
+        outerjoin(RolePermissions, RolePermissions.role_id == Roles.role_id).\
+        outerjoin(Permissions, Permissions.permission_id == RolePermissions.permission_id).\
+        outerjoin(Assets, Assets.id == Permissions.asset_id).\
+        order_by(Users.user_id, Roles.role_id, Permissions.permission_id)
+    if status:
+        query = query.filter(Users.status == status)
+    return query.execution_options(yield_per=EXPORT_BATCH_ROWS)
+
+
+def snapshot_options(dialect_name: str) -> dict:
+    """Connection options of the export transaction, a read-only snapshot where the database has one."""
+    if dialect_name == "postgresql":
+        return {"isolation_level": "REPEATABLE READ", "postgresql_readonly": True}
+    return {}
+
+
+class ExportEncoder:
+    """Turns batches of export rows into chunks of NDJSON or CSV bytes, gzipped if asked.
+    A user's rows may span two batches, so the user being read is only written once the next one starts.
+    """
+
+    def __init__(self, export_format: str = "ndjson", gzip: bool = False,
+                 chunk_bytes: int = EXPORT_CHUNK_BYTES):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}, use one of {', '.join(EXPORT_FORMATS)}.")
+        self.export_format = export_format
+        self.chunk_bytes = chunk_bytes
+        self.users = 0
+        # wbits 31 writes the gzip header and trailer.
+        self._compressor = zlib.compressobj(wbits=31) if gzip else None
+        self._buffer = bytearray()
+        self._user = None  # record of the user being read
+        if export_format == "csv":
+            self._text = io.StringIO()
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(CSV_COLUMNS)
+
+    def feed(self, rows) -> bytes:
+        """Add a batch of rows, return the bytes ready to be written (possibly none)."""
+        for row in rows:
+            if self._user is None or self._user["user_id"] != row.user_id:
+                self._write_user()
+                self._user = {**{column: getattr(row, column) for column in USER_COLUMNS},
+                              "roles": [], "permissions": {}}
+            if row.role_name is not None and row.role_name not in self._user["roles"]:
+                self._user["roles"].append(row.role_name)
+            if row.permission_id is not None:
+                merge_permission(self._user["permissions"], row, row.asset_name)
+        return self._take(self.chunk_bytes)
+
+    def finish(self) -> bytes:
+        """The remaining bytes, including the gzip trailer."""
+        self._write_user()
+        data = self._take(0)
+        if self._compressor is not None:
+            data += self._compressor.flush()
+        return data
+
+    def _write_user(self):
+        user, self._user = self._user, None
+        if user is None:
+            return
+        self.users += 1
+        if self.export_format == "ndjson":
+            self._buffer += orjson.dumps(user, option=orjson.OPT_APPEND_NEWLINE)
+            return
+        for column in ("created_at", "updated_at"):
+            user[column] = user[column].isoformat() if user[column] is not None else None
+        user["roles"] = ";".join(user["roles"])
+        user["permissions"] = orjson.dumps(user["permissions"]).decode()
+        self._csv.writerow([user[column] for column in CSV_COLUMNS])
+
+    def _take(self, min_bytes: int) -> bytes:
+        if self.export_format == "csv":
+            self._buffer += self._text.getvalue().encode()
+            self._text.seek(0)
+            self._text.truncate()
+        if not self._buffer or len(self._buffer) < min_bytes:
+            return b""
+        data, self._buffer = bytes(self._buffer), bytearray()
+        return self._compressor.compress(data) if self._compressor is not None else data
+
+
+async def stream_export(export_format: str = "ndjson", gzip: bool = False, status: str = None):
+    """Async chunks of the export for a streaming response, read from a replica when one is up."""
+    encoder = ExportEncoder(export_format, gzip)
+    async with read_session() as db:
+        await db.connection(execution_options=snapshot_options(db.bind.dialect.name))
+        result = await db.stream(export_query(status))
+        async for rows in result.partitions():
+            chunk = encoder.feed(rows)
+            if chunk:
+                yield chunk
+    yield encoder.finish()
+    logger.info(f"Exported {encoder.users} users as {export_format}.")
+
+
+def write_export(output, export_format: str = "ndjson", gzip: bool = False, status: str = None) -> int:
+    """Write the export to a binary file from the primary, return the number of users written."""
+    encoder = ExportEncoder(export_format, gzip)
+    with SessionLocal() as db:
+        db.connection(execution_options=snapshot_options(db.get_bind().dialect.name))
+        for rows in db.execute(export_query(status)).partitions():
+            output.write(encoder.feed(rows))
+    output.write(encoder.finish())
+    return encoder.users
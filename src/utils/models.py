@@ -1,58 +1,77 @@
 # This is the ORM model module.
+# Columns are declared explicitly to match create_tables.sql, so importing
+# the models does not need a database connection.
 
-from sqlalchemy import MetaData, Column, Integer, Table
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String, func, text
 from sqlalchemy.orm import DeclarativeBase
 
-from .container import engine
-
 
 class Base(DeclarativeBase):
     pass
 
 
-class Users(Base):
+class AuditMixin:
+    """Audit columns shared by every table."""
+    created_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    updated_at = Column(DateTime, server_default=text("CURRENT_TIMESTAMP"), onupdate=func.current_timestamp())
+    created_by = Column(String(100), server_default=text("'system'"))
+    updated_by = Column(String(100), server_default=text("'system'"))
+
+
+class Users(AuditMixin, Base):
     """User model"""
-    __table__ = Table(
-        'users',
-        Base.metadata,
-        Column('user_id', Integer, primary_key=True),
-        autoload_with=engine
-    )
+    __tablename__ = 'users'
+
+    user_id = Column(Integer, primary_key=True)
+    username = Column(String(100), nullable=False, unique=True)
+    password_hash = Column(String(255), nullable=False)
+    email = Column(String(100), unique=True)
+    first_name = Column(String(50))
+    last_name = Column(String(50))
+    status = Column(String(50), server_default=text("'active'"))
+
+
+class Assets(AuditMixin, Base):
+    """Asset model"""
+    __tablename__ = 'assets'
 
+    id = Column(Integer, primary_key=True)
+    asset_name = Column(String(50), nullable=False, unique=True)
+    is_secret = Column(Boolean, server_default=text("TRUE"))
 
-class Permissions(Base):
+
+class Permissions(AuditMixin, Base):
     """Permissions model"""
-    __table__ = Table(
-        'permissions',
-        Base.metadata,
-        Column('permission_id', Integer, primary_key=True),
-        autoload_with=engine
-    )
+    __tablename__ = 'permissions'
+
+    permission_id = Column(Integer, primary_key=True)
+    permission_name = Column(String(50), nullable=False, unique=True)
+    asset_id = Column(Integer, ForeignKey('assets.id'))
+    is_read = Column(Boolean)
+    is_create = Column(Boolean)
+    is_update = Column(Boolean)
+    is_delete = Column(Boolean)
 
 
-class Roles(Base):
+class Roles(AuditMixin, Base):
     """Role model"""
-    __table__ = Table(
-        'roles',
-        Base.metadata,
-        Column('role_id', Integer, primary_key=True),
-        autoload_with=engine
-    )
+    __tablename__ = 'roles'
+
+    role_id = Column(Integer, primary_key=True)
+    role_name = Column(String(50), nullable=False, unique=True)
 
 
-class RolePermissions(Base):
+class RolePermissions(AuditMixin, Base):
     """Role Permission relation model"""
-    __table__ = Table(
-        'role_permissions',
-        Base.metadata,
-        autoload_with=engine
-    )
+    __tablename__ = 'role_permissions'
 
+    role_id = Column(Integer, ForeignKey('roles.role_id'), primary_key=True)
+    permission_id = Column(Integer, ForeignKey('permissions.permission_id'), primary_key=True)
 
-class UserRoles(Base):
+
+class UserRoles(AuditMixin, Base):
     """User Role relation model"""
-    __table__ = Table(
-        'user_roles',
-        Base.metadata,
-        autoload_with=engine
-    )
+    __tablename__ = 'user_roles'
+
+    user_id = Column(Integer, ForeignKey('users.user_id'), primary_key=True)
+    role_id = Column(Integer, ForeignKey('roles.role_id'), primary_key=True)
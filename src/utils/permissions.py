@@ -0,0 +1,24 @@
+# This is the asset permission helper module.
+
+ACTIONS = ("read", "create", "update", "delete")
+
+# Permissions without an asset (like the superuser 'all' permission) apply to every asset.
+ANY_ASSET = "*"
+
+
+def permission_actions(permission) -> dict:
+    """Return the {action: bool} flags of a permission row.
+    A permission without an asset and without flags is the superuser 'all' permission.
+    """
+    flags = {action: bool(getattr(permission, f"is_{action}")) for action in ACTIONS}
+    if permission.asset_id is None and not any(flags.values()):
+        return dict.fromkeys(ACTIONS, True)
+    return flags
+
+
+def merge_permission(asset_permissions: dict, permission, asset_name) -> dict:
+    """Merge a permission row into {asset_name: {action: bool}} and return it."""
+    actions = asset_permissions.setdefault(asset_name or ANY_ASSET, dict.fromkeys(ACTIONS, False))
+    for action, allowed in permission_actions(permission).items():
+        actions[action] = actions[action] or allowed
+    return asset_permissions
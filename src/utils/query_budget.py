@@ -0,0 +1,32 @@
+# This is the SQL query budget helper module.
+# Tests and benchmarks wrap a request in query_budget() to fail when a route starts running
+# more SQL statements than it is allowed to.
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block runs more SQL statements than its budget."""
+
+
+@contextmanager
+def query_budget(engine, max_statements: int, label: str = "Block"):
+    """Count the statements the (sync side of the) engine runs inside the block and raise
+    QueryBudgetExceeded on exit if there are more than max_statements. Yields the statement list.
+    """
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    if len(statements) > max_statements:
+        raise QueryBudgetExceeded(
+            f"{label} ran {len(statements)} SQL statements, the budget is {max_statements}:\n" +
+            "\n".join(statements))
@@ -0,0 +1,78 @@
+# This is the user and role repository module.
+# A repository lives for one request. It folds existence checks into the writes themselves
+# (UPDATE ... RETURNING, INSERT ... ON CONFLICT) instead of selecting first.
+
+from typing import Union
+
+from fastapi import Depends
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .container import get_async_db, get_read_db, upsert_insert
+from .models import Roles, UserRoles, Users
+from .schemas import UserDetails
+
+USER_DETAIL_COLUMNS = [getattr(Users, name) for name in UserDetails.model_fields]
+
+
+class UserRepository:
+    """Request scoped data access for users and their roles."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def create_user(self, values: dict) -> Union[Users, None]:
+        """Insert the user and return it, or None if the username or email is taken."""
+        return await self.db.scalar(
+            upsert_insert(Users).values(**values).on_conflict_do_nothing().returning(Users))
+
+    async def get_active_user_details(self, user_id: int) -> Union[UserDetails, None]:
+        """Only the UserDetails columns of the active user, the password hash is not loaded."""
+        row = (await self.db.execute(
+            select(*USER_DETAIL_COLUMNS).filter(Users.user_id == user_id).filter(Users.status == "active"))).first()
+        return UserDetails.model_construct(**row._mapping) if row is not None else None
+
+    async def update_active_user(self, user_id: int, values: dict) -> Union[Users, None]:
+        """Update the active user and return it, or None if there is no such user."""
+        return await self.db.scalar(
+            update(Users).filter(Users.user_id == user_id).filter(Users.status == "active").
+            values(**values).returning(Users).execution_options(populate_existing=True))
+
+    async def deactivate_user(self, user_id: int) -> bool:
+        """Soft delete the user, return False if there is no such user."""
+        deleted_id = await self.db.scalar(
+            update(Users).filter(Users.user_id == user_id).values(status="inactive").
+            returning(Users.user_id).execution_options(synchronize_session=False))
+        return deleted_id is not None
+
+    async def assign_role(self, user_id: int, role_id: int) -> Union[tuple, None]:
+        """Assign the role and return (username, role_name, assigned), where assigned is False if the
+        user already had the role. Return None if the user or the role does not exist.
+        """
+        row = (await self.db.execute(
+            select(Users.username, Roles.role_name, UserRoles.user_id.label("assigned_user_id")).
+            select_from(Users).
+            join(Roles, Roles.role_id == role_id).
+            outerjoin(UserRoles, (UserRoles.user_id == Users.user_id) & (UserRoles.role_id == Roles.role_id)).
+            filter(Users.user_id == user_id))).first()
+        if row is None:
+            return None
+        if row.assigned_user_id is not None:
+            return row.username, row.role_name, False
+        # A concurrent assignment of the same pair is a conflict, not an error.
+        inserted = await self.db.scalar(
+            upsert_insert(UserRoles).values(user_id=user_id, role_id=role_id).on_conflict_do_nothing().
+            returning(UserRoles.user_id))
+        return row.username, row.role_name, inserted is not None
+
+    async def user_exists(self, user_id: int) -> bool:
+        """Existence check for error messages, the happy paths never need it."""
+        return await self.db.scalar(select(Users.user_id).filter(Users.user_id == user_id)) is not None
+
+
+def get_repository(db: AsyncSession = Depends(get_async_db)) -> UserRepository:
+    return UserRepository(db)
+
+
+def get_read_repository(db: AsyncSession = Depends(get_read_db)) -> UserRepository:
+    return UserRepository(db)
@@ -1,5 +1,8 @@
 # This is to manage pydentic schemas.
 
+from datetime import datetime
+from typing import Dict, List, Optional
+
 from pydantic import BaseModel
 
 
@@ -16,3 +19,73 @@ class AssignUserRole(BaseModel):
     """Schema for API to assign role to a user."""
     user_id: int
     role_id: int
+
+
+class MessageResponse(BaseModel):
+    message: str
+
+
+class UserCreatedResponse(BaseModel):
+    user_name: str
+    message: str
+
+
+class UserMessageResponse(BaseModel):
+    user_id: int
+    message: str
+
+
+class UserDetails(BaseModel):
+    """User columns safe to return, the password hash is never loaded for a response."""
+    user_id: int
+    username: str
+    email: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    status: Optional[str]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    created_by: Optional[str]
+    updated_by: Optional[str]
+
+
+class UserDetailsResponse(BaseModel):
+    user_id: int
+    message: str
+    user_details: UserDetails
+
+
+class UserAccess(BaseModel):
+    user_id: int
+    username: str
+    email: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    status: Optional[str]
+    roles: List[str]
+    permissions: Dict[str, Dict[str, bool]]
+
+
+class UserPage(BaseModel):
+    users: List[UserAccess]
+    next_after_id: Optional[int]
+
+
+class UserSearchResult(BaseModel):
+    user_id: int
+    username: str
+    email: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    status: Optional[str]
+    score: int
+
+
+class UserSearchResponse(BaseModel):
+    users: List[UserSearchResult]
+
+
+class RoleAssignmentResponse(BaseModel):
+    user_name: str
+    role: str
+    message: str
@@ -0,0 +1,13 @@
+# This is the shared code module.
+# Code the src and ums_v2 apps have in common lives in the ums_common package at the repository root.
+# The app runs from its own directory, so the root is put on the import path here.
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+
+from ums_common.replicas import PrimarySession, ReadRouting, ReadYourWritesMiddleware  # noqa: E402
+from ums_common.responses import fast_response  # noqa: E402
@@ -0,0 +1,263 @@
+# This is the in-memory user search index module.
+# Username, email and names are split into lowercase words. The distinct words are kept sorted, so every
+# word starting with a typed prefix is one bisect away, and each word maps to the users having it.
+# The handlers update the index on create, update and soft delete. A background thread picks up users
+# changed through other workers by their updated_at column.
+
+import bisect
+import heapq
+import re
+import threading
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from sqlalchemy import select
+
+from .constants import USER_SEARCH_MAX_CANDIDATES, USER_SEARCH_REFRESH_OVERLAP_SECONDS, USER_SEARCH_REFRESH_SECONDS
+from .container import SessionLocal
+from .models import Users
+
+logger = getLogger(__name__)
+
+# Matches in the username rank above the email, which ranks above the names. Weights are distinct bits,
+# so the weights present in a word's postings fit in one int.
+FIELD_WEIGHTS = {"username": 4, "email": 2, "first_name": 1, "last_name": 1}
+FIELD_WEIGHT_VALUES = frozenset(FIELD_WEIGHTS.values())
+MAX_WEIGHT = max(FIELD_WEIGHT_VALUES)
+# Every score one query word can reach, a weight or an exact match's doubled weight, best first.
+# Words of a prefix range counted to compare the query words by their postings.
+SIZE_SAMPLE_WORDS = 256
+LEAD_SCORES = tuple(sorted({weight * boost for weight in FIELD_WEIGHT_VALUES for boost in (1, 2)}, reverse=True))
+# Users are held as tuples of these columns, a dict per user would take several times the memory.
+USER_COLUMNS = ("user_id", "username", "email", "first_name", "last_name", "status")
+USERNAME, STATUS = USER_COLUMNS.index("username"), USER_COLUMNS.index("status")
+SEARCH_COLUMNS = [Users.user_id, Users.username, Users.email, Users.first_name, Users.last_name, Users.status,
+                  Users.updated_at]
+
+_word_pattern = re.compile(r"[^\W_]+")
+
+
+def words(text: str) -> list:
+    """Lowercase words of the text, anything but letters and digits separates them."""
+    return _word_pattern.findall(text.lower()) if text else []
+
+
+class Postings(dict):
+    """user_id -> weight of the best field having the word, and the weights present (possibly more)."""
+    __slots__ = ("weights",)
+
+    def __init__(self):
+        super().__init__()
+        self.weights = 0
+
+
+class UserSearchIndex:
+    """Prefix index over the searchable user columns."""
+
+    def __init__(self, max_candidates: int = USER_SEARCH_MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self.ready = False
+        self.watermark = None  # Latest updated_at seen.
+        self._users = {}  # user_id -> tuple of USER_COLUMNS
+        self._user_words = {}  # user_id -> words indexed for the user
+        self._postings = {}  # word -> Postings of the users having it
+        self._words = []  # sorted distinct words
+        self._loading = False  # While loading, words are sorted once at the end instead of on every insert.
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def upsert(self, user: dict):
+        """Index the user, replacing what was indexed for its user_id."""
+        user_id = user["user_id"]
+        weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for word in words(user.get(field)):
+                weights[word] = max(weights.get(word, 0), weight)
+        with self._lock:
+            self._remove_words(user_id)
+            self._users[user_id] = tuple(user.get(column) for column in USER_COLUMNS)
+            self._user_words[user_id] = tuple(weights)
+            for word, weight in weights.items():
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = Postings()
+                    if not self._loading:
+                        bisect.insort(self._words, word)
+                postings[user_id] = weight
+                postings.weights |= weight
+
+    def set_status(self, user_id: int, status: str):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is not None:
+                self._users[user_id] = user[:STATUS] + (status,) + user[STATUS + 1:]
+
+    def _remove_words(self, user_id: int):
+        for word in self._user_words.pop(user_id, ()):
+            postings = self._postings[word]
+            postings.pop(user_id, None)
+            if not postings:
+                del self._postings[word]
+                if not self._loading:
+                    del self._words[bisect.bisect_left(self._words, word)]
+
+    def search(self, query: str, status: str = "active", limit: int = 20) -> list:
+        """Users having a word starting with every word of the query, best matches first.
+        A user scores the field weight per query word, doubled when the word matches exactly.
+        """
+        query_words = set(words(query))
+        if not query_words:
+            return []
+        with self._lock:
+            # The word with the fewest postings is looked up in the index, the other words only filter
+            # its candidates through the words of each candidate. Candidates come best lead score first,
+            # so the cap on candidates only ever drops the weakest.
+            ranges = {word: self._prefix_range(word) for word in query_words}
+            lead = min(ranges, key=lambda word: self._postings_size(*ranges[word])) if len(ranges) > 1 \
+                else next(iter(ranges))
+            others = [word for word in query_words if word != lead]
+            others_best = sum(self._best_score(word, *ranges[word]) for word in others)
+            scores = {}
+            ceiling = top = None  # best score still possible, candidates already scoring it
+            for user_id, lead_score in self._lead_candidates(lead, *ranges[lead], status):
+                if lead_score + others_best != ceiling:
+                    ceiling = lead_score + others_best
+                    top = sum(1 for score in scores.values() if score >= ceiling)
+                if top >= limit:
+                    # Nobody left can outscore the best `limit` candidates.
+                    break
+                other_score = self._other_score(user_id, others)
+                if other_score is None:
+                    continue
+                scores[user_id] = lead_score + other_score
+                if scores[user_id] >= ceiling:
+                    top += 1
+                if len(scores) >= self.max_candidates:
+                    break
+            ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (
+                -item[1], len(self._users[item[0]][USERNAME]), item[0]))
+            return [{**dict(zip(USER_COLUMNS, self._users[user_id])), "score": score} for user_id, score in ranked]
+
+    def _prefix_range(self, prefix: str) -> tuple:
+        """(low, high) positions of the words starting with the prefix in the sorted words."""
+        low = bisect.bisect_left(self._words, prefix)
+        return low, bisect.bisect_left(self._words, prefix + "\U0010ffff", lo=low)
+
+    def _postings_size(self, low: int, high: int) -> float:
+        """Postings of the words in the range, extrapolated from its first words when it is long."""
+        sample = min(high - low, SIZE_SAMPLE_WORDS)
+        if not sample:
+            return 0
+        return sum(len(self._postings[self._words[index]]) for index in range(low, low + sample)) * \
+            (high - low) / sample
+
+    def _best_score(self, word: str, low: int, high: int) -> int:
+        """Highest score the query word can reach for any user."""
+        exact = self._postings.get(word)
+        best = 2 * (1 << (exact.weights.bit_length() - 1)) if exact else 0
+        return max(best, MAX_WEIGHT) if high - low > (1 if exact else 0) else best
+
+    def _lead_candidates(self, lead: str, low: int, high: int, status: str):
+        """Yield (user_id, score for the lead word) of the users with the status matching it,
+        best score first and once per user.
+        """
+        seen, users = set(), self._users
+        for lead_score in LEAD_SCORES:
+            for word, weight in self._tier_words(lead, low, high, lead_score):
+                for user_id, user_weight in self._postings[word].items():
+                    if user_weight == weight and user_id not in seen and users[user_id][STATUS] == status:
+                        seen.add(user_id)
+                        yield user_id, lead_score
+
+    def _tier_words(self, lead: str, low: int, high: int, lead_score: int):
+        """Yield (word, field weight) of the lead word's range whose postings may score lead_score."""
+        if lead_score > MAX_WEIGHT:
+            # Only an exact match scores above every weight, and the exact word sorts first.
+            high = min(high, low + 1)
+        postings = self._postings
+        for index in range(low, high):
+            word = self._words[index]
+            # An exact match doubles the weight.
+            weight = lead_score // 2 if word == lead else lead_score
+            if weight in FIELD_WEIGHT_VALUES and postings[word].weights & weight:
+                yield word, weight
+
+    def _other_score(self, user_id: int, others: list):
+        """Sum of the best score of each other query word among the user's words, None if one does not match."""
+        total = 0
+        user_words = self._user_words[user_id]
+        for query_word in others:
+            best = 0
+            for word in user_words:
+                if word.startswith(query_word):
+                    score = self._postings[word][user_id] * (2 if word == query_word else 1)
+                    if score > best:
+                        best = score
+            if not best:
+                return None
+            total += best
+        return total
+
+    def load(self, db):
+        """Index every user, streaming the rows."""
+        logger.info("Loading the user search index.")
+        self._loading = True
+        try:
+            for row in db.execute(select(*SEARCH_COLUMNS).execution_options(yield_per=10000)):
+                self._apply(row)
+        finally:
+            with self._lock:
+                self._words = sorted(self._postings)
+                self._loading = False
+        self.ready = True
+        logger.info(f"User search index loaded with {len(self._users)} users.")
+
+    def refresh(self, db):
+        """Index the users changed since the last load or refresh."""
+        if not self.ready:
+            return self.load(db)
+        since = self.watermark - timedelta(seconds=USER_SEARCH_REFRESH_OVERLAP_SECONDS) if self.watermark \
+            else datetime.min
+        for row in db.execute(select(*SEARCH_COLUMNS).filter(Users.updated_at > since)):
+            self._apply(row)
+
+    def _apply(self, row):
+        self.upsert(row._asdict())
+        if row.updated_at is not None and (self.watermark is None or row.updated_at > self.watermark):
+            self.watermark = row.updated_at
+
+
+search_index = UserSearchIndex()
+
+
+def _refresh_loop(stop: threading.Event):
+    while not stop.wait(USER_SEARCH_REFRESH_SECONDS):
+        db = SessionLocal()
+        try:
+            search_index.refresh(db)
+        except Exception as error:
+            logger.error(f"Error in refreshing the user search index: {error}")
+        finally:
+            db.close()
+
+
+def start_search_refresher() -> threading.Event:
+    """Load the index and keep it fresh from a daemon thread, so server start does not wait for the load.
+    Set the returned event to stop it.
+    """
+    stop = threading.Event()
+
+    def run():
+        db = SessionLocal()
+        try:
+            search_index.load(db)
+        except Exception as error:
+            logger.error(f"Error in loading the user search index: {error}")
+        finally:
+            db.close()
+        _refresh_loop(stop)
+
+    threading.Thread(target=run, name="user-search-refresher", daemon=True).start()
+    return stop
@@ -0,0 +1,126 @@
+# This is the shared fixtures module of the src and ums_v2 api tests.
+# Each app runs in-process against its own throwaway SQLite database, which has to be configured
+# before the app modules are imported since they create their engines at import time.
+
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed_database(models, db):
+    """Create the tables and the roles, assets and permissions the tests rely on."""
+    models.Base.metadata.create_all(db.get_bind())
+    db.add_all([
+        models.Roles(role_id=1, role_name="admin"),
+        models.Roles(role_id=2, role_name="staff"),
+        models.Assets(id=1, asset_name="business", is_secret=True),
+        models.Assets(id=2, asset_name="marketing", is_secret=False),
+        models.Permissions(permission_id=1, permission_name="all"),
+        models.Permissions(permission_id=2, permission_name="marketing_read", asset_id=2, is_read=True),
+    ])
+    db.flush()
+    db.add_all([models.RolePermissions(role_id=1, permission_id=1), models.RolePermissions(role_id=2, permission_id=2)])
+    db.commit()
+
+
+def use_database(directory):
+    """Point the app about to be imported at a fresh SQLite database in the directory."""
+    database = directory / "ums.db"
+    os.environ["UMS_DATABASE_URL"] = f"sqlite:///{database}"
+    os.environ["UMS_ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{database}"
+
+
+def load_main(name: str, app_root: str):
+    """Import an app's main module under a unique name, both apps call theirs `main`."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(app_root, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def src_main(tmp_path_factory):
+    """The src main module, imported against a fresh database."""
+    use_database(tmp_path_factory.mktemp("src"))
+    sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+    from utils import models
+    from utils.container import SessionLocal
+
+    db = SessionLocal()
+    try:
+        seed_database(models, db)
+    finally:
+        db.close()
+    return load_main("src_main", os.path.join(REPO_ROOT, "src"))
+
+
+@pytest.fixture(scope="session")
+def client(src_main):
+    from fastapi.testclient import TestClient
+    from utils.user_search import search_index
+
+    with TestClient(src_main.app) as test_client:
+        # The search index loads in the background after startup.
+        deadline = time.monotonic() + 30
+        while not search_index.ready and time.monotonic() < deadline:
+            time.sleep(0.05)
+        yield test_client
+
+
+@pytest.fixture
+def budget(src_main):
+    """budget(max_statements) is a context manager failing the test when the block runs more SQL statements."""
+    from utils.container import async_engine
+    from utils.query_budget import query_budget
+
+    def within(max_statements: int):
+        return query_budget(async_engine.sync_engine, max_statements)
+    return within
+
+
+@pytest.fixture(scope="session")
+def ums_v2_main(tmp_path_factory):
+    """The ums_v2 main module, imported against a fresh database and hashing passwords at the lowest cost."""
+    directory = tmp_path_factory.mktemp("ums_v2")
+    use_database(directory)
+    os.environ.update({"UMS_PASSWORD_ROUNDS": "bcrypt=4", "UMS_PASSWORD_POOL_WORKERS": "1",
+                       "UMS_LOGIN_IP_RATE": "1000/60"})
+    # The app logs to app.log in the working directory.
+    os.chdir(directory)
+    sys.path.insert(0, os.path.join(REPO_ROOT, "ums_v2"))
+    import models
+    from container import SessionLocal
+
+    db = SessionLocal()
+    try:
+        seed_database(models, db)
+    finally:
+        db.close()
+    return load_main("ums_v2_main", os.path.join(REPO_ROOT, "ums_v2"))
+
+
+@pytest.fixture(scope="session")
+def ums_v2_client(ums_v2_main):
+    from fastapi.testclient import TestClient
+
+    # The RBAC index is loaded by the startup event, before the first request.
+    with TestClient(ums_v2_main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def ums_v2_db(ums_v2_main):
+    """Sync session on the ums_v2 database, to change roles and permissions behind the app's back."""
+    from container import SessionLocal
+
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
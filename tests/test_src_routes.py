@@ -0,0 +1,156 @@
+# This is the src api routes test module.
+# Every request runs inside a SQL query budget, so a route that starts running more statements
+# than it needs, on its happy, not found or conflict path, fails here before it reaches a benchmark.
+
+import itertools
+
+import orjson
+
+user_numbers = itertools.count(1)
+
+
+def user_body(username: str, **values) -> dict:
+    return {"username": username, "password_hash": "hash", "email": f"{username}@example.com",
+            "first_name": "Test", "last_name": "User", **values}
+
+
+def create_user(client) -> tuple:
+    """Create a fresh user outside any budget, return (user_id, username)."""
+    username = f"test_user_{next(user_numbers)}"
+    assert client.post("/users/create", json=user_body(username)).status_code == 201
+    user_id = client.get("/users/search", params={"q": username}).json()["users"][0]["user_id"]
+    return user_id, username
+
+
+def test_healthcheck(client, budget):
+    with budget(0):
+        response = client.get("/healthcheck")
+    assert response.status_code == 200
+
+
+def test_create_user(client, budget):
+    with budget(1):
+        response = client.post("/users/create", json=user_body("created_user"))
+    assert response.status_code == 201
+    assert response.json()["user_name"] == "created_user"
+
+
+def test_create_user_conflict(client, budget):
+    _, username = create_user(client)
+    with budget(1):
+        response = client.post("/users/create", json=user_body(username))
+    assert response.status_code == 400
+
+
+def test_list_users(client, budget):
+    user_id, _ = create_user(client)
+    client.post("/assign_role", json={"user_id": user_id, "role_id": 2})
+    with budget(2):
+        response = client.get("/users", params={"limit": 1000})
+    assert response.status_code == 200
+    users = {user["user_id"]: user for user in response.json()["users"]}
+    assert users[user_id]["roles"] == ["staff"]
+
+
+def test_list_users_empty_page(client, budget):
+    with budget(1):
+        response = client.get("/users", params={"after_id": 10 ** 9})
+    assert response.json() == {"users": [], "next_after_id": None}
+
+
+def test_search_users(client, budget):
+    _, username = create_user(client)
+    with budget(0):
+        response = client.get("/users/search", params={"q": username})
+    assert [user["username"] for user in response.json()["users"]] == [username]
+
+
+def test_export_users(client, budget):
+    _, username = create_user(client)
+    with budget(1):
+        response = client.get("/users/export", params={"format": "ndjson"})
+    assert response.status_code == 200
+    assert username in [orjson.loads(line)["username"] for line in response.content.splitlines()]
+
+
+def test_get_user(client, budget):
+    user_id, username = create_user(client)
+    with budget(1):
+        response = client.get(f"/users/{user_id}")
+    assert response.status_code == 200
+    assert response.json()["user_details"]["username"] == username
+
+
+def test_get_user_not_found(client, budget):
+    with budget(1):
+        response = client.get(f"/users/{10 ** 9}")
+    assert response.status_code == 404
+
+
+def test_update_user(client, budget):
+    user_id, username = create_user(client)
+    with budget(1):
+        response = client.put(f"/users/{user_id}", json=user_body(username, first_name="Updated"))
+    assert response.status_code == 200
+    assert client.get(f"/users/{user_id}").json()["user_details"]["first_name"] == "Updated"
+
+
+def test_update_user_not_found(client, budget):
+    with budget(1):
+        response = client.put(f"/users/{10 ** 9}", json=user_body("missing_user"))
+    assert response.status_code == 404
+
+
+def test_update_user_conflict(client, budget):
+    user_id, username = create_user(client)
+    _, other_username = create_user(client)
+    with budget(1):
+        response = client.put(f"/users/{user_id}", json=user_body(other_username))
+    assert response.status_code == 400
+    assert client.get(f"/users/{user_id}").json()["user_details"]["username"] == username
+
+
+def test_delete_user(client, budget):
+    user_id, _ = create_user(client)
+    with budget(1):
+        response = client.delete(f"/users/{user_id}")
+    assert response.status_code == 200
+    assert client.get(f"/users/{user_id}").status_code == 404
+
+
+def test_delete_user_not_found(client, budget):
+    with budget(1):
+        response = client.delete(f"/users/{10 ** 9}")
+    assert response.status_code == 404
+
+
+def test_assign_role(client, budget):
+    user_id, username = create_user(client)
+    with budget(2):
+        response = client.post("/assign_role", json={"user_id": user_id, "role_id": 1})
+    assert response.status_code == 200
+    assert response.json()["user_name"] == username and response.json()["role"] == "admin"
+
+
+def test_assign_role_already_assigned(client, budget):
+    user_id, _ = create_user(client)
+    client.post("/assign_role", json={"user_id": user_id, "role_id": 1})
+    with budget(1):
+        response = client.post("/assign_role", json={"user_id": user_id, "role_id": 1})
+    assert response.status_code == 200
+    assert response.json()["message"] == "Role already has been assigned!"
+
+
+def test_assign_role_user_not_found(client, budget):
+    with budget(2):
+        response = client.post("/assign_role", json={"user_id": 10 ** 9, "role_id": 1})
+    assert response.status_code == 404
+    assert "User not found!" in response.json()["detail"]
+
+
+def test_assign_role_role_not_found(client, budget):
+    user_id, _ = create_user(client)
+    with budget(2):
+        response = client.post("/assign_role", json={"user_id": user_id, "role_id": 10 ** 6})
+    assert response.status_code == 404
+    assert "Role not found!" in response.json()["detail"]
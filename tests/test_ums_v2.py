@@ -0,0 +1,267 @@
+# This is the ums_v2 api behaviour test module.
+# Access tokens carry the user's roles and permissions, so these tests change roles and permissions
+# behind the app's back and check that tokens issued before the change stop granting what was taken away.
+# The session, revocation, admission and bulk import paths are covered the same way, through the api.
+
+import asyncio
+import itertools
+
+import orjson
+import pytest
+from sqlalchemy import delete, select, text, update
+
+user_numbers = itertools.count(1)
+role_numbers = itertools.count(1)
+
+
+def bearer(access_token: str) -> dict:
+    return {"Authorization": f"Bearer {access_token}"}
+
+
+def register(client, db) -> tuple:
+    """Register a fresh user, return (user_id, username)."""
+    username = f"v2_user_{next(user_numbers)}"
+    response = client.post("/users/v1/register",
+                           json={"username": username, "password": "secret", "email": f"{username}@example.com"})
+    assert response.json() == {"message": "User registered successfully"}
+    import models
+
+    return db.scalar(select(models.Users.user_id).filter(models.Users.username == username)), username
+
+
+def login(client, username: str) -> dict:
+    response = client.post("/users/v1/login", json={"username": username, "password": "secret"})
+    assert response.status_code == 200
+    return response.json()
+
+
+def can_read(client, access_token: str, asset: str) -> bool:
+    response = client.post("/authz/v1/check", headers=bearer(access_token),
+                           json={"checks": [{"asset": asset, "action": "read"}]})
+    assert response.status_code == 200
+    return response.json()["results"][0]["allowed"]
+
+
+def can_read_marketing(client, access_token: str) -> bool:
+    return can_read(client, access_token, "marketing")
+
+
+def reload_index(db):
+    from rbac import rbac_index
+
+    rbac_index.load(db)
+
+
+@pytest.fixture(scope="module")
+def admin_token(ums_v2_client, ums_v2_main):
+    """Access token of an admin, whose role is granted in the db."""
+    import models
+    from container import SessionLocal
+
+    db = SessionLocal()
+    try:
+        user_id, username = register(ums_v2_client, db)
+        db.add(models.UserRoles(user_id=user_id, role_id=1))
+        db.commit()
+        reload_index(db)
+    finally:
+        db.close()
+    return login(ums_v2_client, username)["access_token"]
+
+
+@pytest.fixture
+def reader_role(ums_v2_db):
+    """A role of its own granting marketing read, return (role_id, permission_id)."""
+    import models
+
+    number = next(role_numbers)
+    role = models.Roles(role_name=f"reader_{number}")
+    permission = models.Permissions(permission_name=f"reader_{number}_read", asset_id=2, is_read=True)
+    ums_v2_db.add_all([role, permission])
+    ums_v2_db.flush()
+    ums_v2_db.add(models.RolePermissions(role_id=role.role_id, permission_id=permission.permission_id))
+    ums_v2_db.commit()
+    reload_index(ums_v2_db)
+    return role.role_id, permission.permission_id
+
+
+def reader_token(client, db, admin_token: str, role_id: int) -> tuple:
+    """Register a user, assign them the role through the api and log in, return (user_id, access token)."""
+    user_id, username = register(client, db)
+    response = client.post("/assign_role", headers=bearer(admin_token), json={"user_id": user_id, "role_id": role_id})
+    assert response.status_code == 200
+    return user_id, login(client, username)["access_token"]
+
+
+def test_revoked_role_outdates_token(ums_v2_client, ums_v2_db, admin_token, reader_role):
+    import models
+
+    role_id, _ = reader_role
+    user_id, access_token = reader_token(ums_v2_client, ums_v2_db, admin_token, role_id)
+    assert can_read_marketing(ums_v2_client, access_token)
+
+    ums_v2_db.execute(delete(models.UserRoles).filter(models.UserRoles.user_id == user_id))
+    ums_v2_db.commit()
+    reload_index(ums_v2_db)
+
+    assert not can_read_marketing(ums_v2_client, access_token)
+
+
+def test_permission_removed_from_held_role_outdates_token(ums_v2_client, ums_v2_db, admin_token, reader_role):
+    import models
+
+    role_id, permission_id = reader_role
+    _, access_token = reader_token(ums_v2_client, ums_v2_db, admin_token, role_id)
+    assert can_read_marketing(ums_v2_client, access_token)
+
+    # Deleted rows are only seen by a full reload.
+    ums_v2_db.execute(delete(models.RolePermissions).filter(models.RolePermissions.role_id == role_id))
+    ums_v2_db.commit()
+    reload_index(ums_v2_db)
+
+    assert not can_read_marketing(ums_v2_client, access_token)
+
+
+def test_permission_flag_cleared_outdates_token(ums_v2_client, ums_v2_db, admin_token, reader_role):
+    import models
+    from rbac import rbac_index
+
+    role_id, permission_id = reader_role
+    _, access_token = reader_token(ums_v2_client, ums_v2_db, admin_token, role_id)
+    assert can_read_marketing(ums_v2_client, access_token)
+
+    # Changed rows are picked up by the incremental refresh.
+    ums_v2_db.execute(update(models.Permissions).filter(models.Permissions.permission_id == permission_id).
+                      values(is_read=False))
+    ums_v2_db.commit()
+    rbac_index.refresh(ums_v2_db)
+
+    assert not can_read_marketing(ums_v2_client, access_token)
+
+
+def test_stale_version_claims_are_not_trusted(ums_v2_client, ums_v2_db, admin_token, reader_role):
+    from user_auth import create_access_token, decode_access_token
+
+    role_id, _ = reader_role
+    _, access_token = reader_token(ums_v2_client, ums_v2_db, admin_token, role_id)
+    claims = decode_access_token(access_token)
+    # Claims granting business read, as if the user held it when the token was issued.
+    claims = {key: claims[key] for key in ("sub", "uid", "roles", "ver")} | \
+        {"perms": {**claims["perms"], "business": 1}}
+
+    assert can_read(ums_v2_client, create_access_token(claims), "business")
+    stale_token = create_access_token({**claims, "ver": claims["ver"] - 1})
+    assert not can_read(ums_v2_client, stale_token, "business")
+    assert can_read_marketing(ums_v2_client, stale_token)
+
+
+def test_refresh_rotates_token(ums_v2_client, ums_v2_db):
+    _, username = register(ums_v2_client, ums_v2_db)
+    refresh_token = login(ums_v2_client, username)["refresh_token"]
+
+    response = ums_v2_client.post("/users/v1/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 200
+    rotated_token = response.json()["refresh_token"]
+    assert rotated_token != refresh_token
+    assert ums_v2_client.post("/users/v1/token/refresh", json={"refresh_token": rotated_token}).status_code == 200
+
+
+def test_reused_refresh_token_revokes_session(ums_v2_client, ums_v2_db):
+    _, username = register(ums_v2_client, ums_v2_db)
+    refresh_token = login(ums_v2_client, username)["refresh_token"]
+    rotated_token = ums_v2_client.post("/users/v1/token/refresh",
+                                       json={"refresh_token": refresh_token}).json()["refresh_token"]
+
+    response = ums_v2_client.post("/users/v1/token/refresh", json={"refresh_token": refresh_token})
+    assert response.status_code == 401
+    # Whoever presented the rotated token may hold the current one too, so the session is gone.
+    assert ums_v2_client.post("/users/v1/token/refresh", json={"refresh_token": rotated_token}).status_code == 401
+
+
+def test_logout_revokes_access_token(ums_v2_client, ums_v2_db, admin_token, reader_role):
+    role_id, _ = reader_role
+    _, access_token = reader_token(ums_v2_client, ums_v2_db, admin_token, role_id)
+    assert can_read_marketing(ums_v2_client, access_token)
+
+    assert ums_v2_client.post("/users/v1/logout", headers=bearer(access_token)).status_code == 200
+
+    assert ums_v2_client.post("/authz/v1/check", headers=bearer(access_token),
+                              json={"checks": [{"asset": "marketing", "action": "read"}]}).status_code == 401
+
+
+def test_saturated_class_sheds_with_retry_after(ums_v2_client, monkeypatch):
+    from admission import CostClass, cost_classes
+
+    saturated = CostClass("read", limit=1, queue_size=0)
+    monkeypatch.setitem(cost_classes, "read", saturated)
+    assert asyncio.run(saturated.acquire())
+    try:
+        response = ums_v2_client.get("/assets/v1/marketing")
+    finally:
+        saturated.release()
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert saturated.shed == 1
+    # Other classes are not affected.
+    assert ums_v2_client.get("/healthcheck").status_code == 200
+
+
+def test_login_attempts_are_limited_per_username(ums_v2_main, ums_v2_client, ums_v2_db, monkeypatch):
+    from admission import LoginLimiter
+
+    monkeypatch.setattr(ums_v2_main, "login_limiter", LoginLimiter(username_rate=(2, 60), ip_rate=(1000, 60)))
+    _, username = register(ums_v2_client, ums_v2_db)
+    login(ums_v2_client, username)
+    login(ums_v2_client, username)
+
+    response = ums_v2_client.post("/users/v1/login", json={"username": username, "password": "secret"})
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+
+
+def import_csv(client, admin_token: str, csv: str) -> list:
+    response = client.post("/users/v1/bulk_register", headers={**bearer(admin_token), "Content-Type": "text/csv"},
+                           content=csv.encode())
+    assert response.status_code == 200
+    return [orjson.loads(line) for line in response.text.splitlines()]
+
+
+def test_csv_import_reports_every_row(ums_v2_client, ums_v2_db, admin_token):
+    _, existing = register(ums_v2_client, ums_v2_db)
+    results = import_csv(ums_v2_client, admin_token, "\n".join([
+        "username,email,password",
+        "csv_user_1,csv_user_1@example.com,secret",
+        f"{existing},{existing}@example.com,secret",
+        "csv_user_1,csv_user_1@example.com,secret",
+        f"{'x' * 101},long@example.com,secret",
+        "csv_user_2,missing a column",
+        '"csv_user_2","csv_user_2@example.com","sec,ret"',
+    ]))
+
+    assert [(result["line"], result["status"]) for result in results[:-1]] == [
+        (2, "created"), (3, "duplicate"), (4, "duplicate"), (5, "invalid"), (6, "invalid"), (7, "created")]
+    assert results[-1] == {"summary": {"created": 2, "duplicate": 2, "invalid": 2, "error": 0}}
+    assert login(ums_v2_client, "csv_user_1")["access_token"]
+    assert ums_v2_client.post("/users/v1/login",
+                              json={"username": "csv_user_2", "password": "sec,ret"}).status_code == 200
+
+
+def test_csv_import_reports_rows_that_cannot_be_stored(ums_v2_client, ums_v2_db, admin_token):
+    ums_v2_db.execute(text("CREATE TRIGGER reject_import BEFORE INSERT ON users WHEN NEW.username = 'csv_broken' "
+                           "BEGIN SELECT RAISE(ABORT, 'rejected'); END"))
+    ums_v2_db.commit()
+    try:
+        results = import_csv(ums_v2_client, admin_token, "\n".join([
+            "username,email,password",
+            "csv_user_3,csv_user_3@example.com,secret",
+            "csv_broken,csv_broken@example.com,secret",
+            "csv_user_4,csv_user_4@example.com,secret",
+        ]))
+    finally:
+        ums_v2_db.execute(text("DROP TRIGGER reject_import"))
+        ums_v2_db.commit()
+
+    # The failing batch is stored again row by row, so only the broken row is lost.
+    assert [result["status"] for result in results[:-1]] == ["created", "error", "created"]
+    assert results[-1] == {"summary": {"created": 2, "duplicate": 0, "invalid": 0, "error": 1}}
@@ -0,0 +1,192 @@
+# This is the shared read replica routing module of the src and ums_v2 apps.
+# Read-only handlers get a session on a healthy replica, round-robin, or on the primary when no replica is up
+# or the client wrote in the last few seconds, so it reads its own writes.
+
+import contextvars
+import itertools
+import time
+from contextlib import asynccontextmanager
+from logging import getLogger
+
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.requests import cookie_parser
+
+logger = getLogger(__name__)
+
+# {"sticky": reads go to the primary, "wrote": the primary committed} of the request being served,
+# set by the read-your-writes middleware.
+request_routing = contextvars.ContextVar("request_routing", default=None)
+
+
+class PrimarySession(Session):
+    """Session class of the primary, its commits make the client's next reads stick to the primary."""
+
+
+@event.listens_for(PrimarySession, "after_commit")
+def mark_primary_write(session):
+    routing = request_routing.get()
+    if routing is not None:
+        routing["wrote"] = True
+
+
+class ReplicaRouter:
+    """Round-robin over the replica engines, skipping the ones that failed recently."""
+
+    def __init__(self, engines: list, retry_seconds: float):
+        self.engines = engines
+        self.retry_seconds = retry_seconds
+        self._turn = itertools.count()
+        self._down_until = {}  # engine -> epoch it is tried again
+        for replica in engines:
+            event.listen(replica.sync_engine, "handle_error", self._error_listener(replica))
+
+    def candidates(self) -> list:
+        """The healthy replicas, starting with the one whose turn it is."""
+        if not self.engines:
+            return []
+        start = next(self._turn) % len(self.engines)
+        now = time.time()
+        return [replica for replica in self.engines[start:] + self.engines[:start]
+                if self._down_until.get(replica, 0) <= now]
+
+    def mark_down(self, replica):
+        logger.error(f"Replica {replica.url} is down, skipping it for {self.retry_seconds} seconds.")
+        self._down_until[replica] = time.time() + self.retry_seconds
+
+    def _error_listener(self, replica):
+        def handle_error(context):
+            if context.is_disconnect:
+                self.mark_down(replica)
+        return handle_error
+
+
+class ReplicaSession(AsyncSession):
+    """Session of a read bound to a replica connection.
+    A pooled connection may have been dropped by the replica since its last use, which only shows on the first
+    statement. Nothing was read on it yet, so that statement is run again on the next candidate connection.
+    """
+
+    def __init__(self, connection, next_connection):
+        super().__init__(bind=connection, autoflush=False, expire_on_commit=False)
+        self._next_connection = next_connection  # None once a statement went through
+        self._execution_options = None
+
+    async def connection(self, **kwargs):
+        # Kept to set them again on the next candidate.
+        self._execution_options = kwargs.get("execution_options") or self._execution_options
+        return await super().connection(**kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._first_statement(super().execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._first_statement(super().scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._first_statement(super().scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._first_statement(super().get, *args, **kwargs)
+
+    async def stream(self, *args, **kwargs):
+        return await self._first_statement(super().stream, *args, **kwargs)
+
+    async def stream_scalars(self, *args, **kwargs):
+        return await self._first_statement(super().stream_scalars, *args, **kwargs)
+
+    async def _first_statement(self, statement, *args, **kwargs):
+        while self._next_connection is not None:
+            try:
+                result = await statement(*args, **kwargs)
+            except DBAPIError as error:
+                if not error.connection_invalidated:
+                    raise
+                logger.error(f"Lost the connection to {self.bind.engine.url}, reading from the next candidate.")
+                await self.close()
+                connection = await self._next_connection()
+                self.bind = connection
+                self.sync_session.bind = connection.sync_connection
+                if self._execution_options:
+                    await super().connection(execution_options=self._execution_options)
+                continue
+            self._next_connection = None
+            return result
+        return await statement(*args, **kwargs)
+
+
+class ReadRouting:
+    """Hands out read sessions on the replicas of one primary."""
+
+    def __init__(self, primary_engine, primary_sessions, replica_engines: list, retry_seconds: float):
+        self.primary_engine = primary_engine
+        self.primary_sessions = primary_sessions
+        self.router = ReplicaRouter(replica_engines, retry_seconds)
+
+    @asynccontextmanager
+    async def read_session(self):
+        """Session on a healthy replica, or on the primary when the client just wrote or no replica is up."""
+        routing = request_routing.get()
+        candidates = iter(self.router.candidates() if routing is None or not routing["sticky"] else ())
+        connection = await self._connect_replica(candidates)
+        if connection is None:
+            async with self.primary_sessions() as db:
+                yield db
+            return
+        connections = [connection]
+
+        async def next_connection():
+            connections.append(await self._connect_replica(candidates) or await self.primary_engine.connect())
+            return connections[-1]
+
+        try:
+            async with ReplicaSession(connection, next_connection) as db:
+                yield db
+        finally:
+            for connection in connections:
+                await connection.close()
+
+    async def _connect_replica(self, candidates):
+        for replica in candidates:
+            try:
+                return await replica.connect()
+            except (DBAPIError, OSError) as error:
+                logger.error(f"Could not connect to replica {replica.url}: {error}")
+                self.router.mark_down(replica)
+        return None
+
+
+class ReadYourWritesMiddleware:
+    """ASGI middleware keeping a client's reads on the primary for sticky_seconds after it wrote,
+    through a cookie holding the epoch until which its reads are sticky.
+    """
+
+    def __init__(self, app, cookie_name: str, sticky_seconds: int):
+        self.app = app
+        self.cookie_name = cookie_name
+        self.sticky_seconds = sticky_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        cookies = cookie_parser(dict(scope["headers"]).get(b"cookie", b"").decode("latin-1"))
+        try:
+            sticky_until = float(cookies.get(self.cookie_name, 0))
+        except ValueError:
+            sticky_until = 0
+        routing = {"sticky": sticky_until > time.time(), "wrote": False}
+        token = request_routing.set(routing)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and routing["wrote"]:
+                cookie = f"{self.cookie_name}={time.time() + self.sticky_seconds:.3f}; " \
+                         f"Max-Age={self.sticky_seconds}; Path=/; HttpOnly; SameSite=Lax"
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            request_routing.reset(token)
@@ -0,0 +1,13 @@
+# This is the shared response helper module of the src and ums_v2 apps.
+
+from typing import Type
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def fast_response(model: Type[BaseModel], status_code: int = 200, **values) -> ORJSONResponse:
+    """Serialize handler output with orjson, skipping the response model validation.
+    Only for values the handler built itself from typed columns, the route still declares the model.
+    """
+    return ORJSONResponse(model.model_construct(**values).model_dump(), status_code=status_code)
@@ -0,0 +1,128 @@
+# This is the admission control module.
+# Routes are grouped into cost classes with their own concurrency limit and bounded wait queue, so a spike
+# of password hashing cannot take the cached reads and the health check down with it. Requests beyond the
+# queue are shed at once with 503 instead of piling up in the worker.
+# Login attempts also pass per-username and per-IP token buckets before any password is verified.
+
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+from fastapi.responses import ORJSONResponse
+
+from app_logger import logging
+from constants import ADMISSION_BYPASS_PATHS, ADMISSION_LIMITS, ADMISSION_RETRY_AFTER_SECONDS, \
+    ADMISSION_ROUTE_CLASSES, ADMISSION_WAIT_SECONDS, LOGIN_IP_RATE, LOGIN_USERNAME_RATE, RATE_LIMIT_MAX_KEYS
+
+
+class CostClass:
+    """Concurrency limit with a bounded wait queue for one class of routes."""
+
+    def __init__(self, name: str, limit: int, queue_size: int, wait_seconds: float = ADMISSION_WAIT_SECONDS):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait_seconds = wait_seconds
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        """Wait for a slot, return False if the request has to be shed instead."""
+        if self._semaphore.locked():
+            if self.waiting >= self.queue_size:
+                self.shed += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_seconds)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            # Free slot, acquire() returns without suspending.
+            await self._semaphore.acquire()
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting,
+                "admitted": self.admitted, "shed": self.shed}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware admitting each request through the cost class of its path."""
+
+    def __init__(self, app, classes: dict = None):
+        self.app = app
+        self.classes = classes if classes is not None else cost_classes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in ADMISSION_BYPASS_PATHS:
+            return await self.app(scope, receive, send)
+        cost_class = self.classes[ADMISSION_ROUTE_CLASSES.get(scope["path"], "default")]
+        if not await cost_class.acquire():
+            logging.error("Shedding %s, the %s class is saturated.", scope["path"], cost_class.name)
+            response = ORJSONResponse({"detail": "Server is busy, please retry."}, status_code=503,
+                                      headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            cost_class.release()
+
+
+class TokenBuckets:
+    """Token bucket per key holding up to `attempts` tokens, refilled at attempts per `seconds`."""
+
+    def __init__(self, attempts: float, seconds: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.capacity = attempts
+        self.rate = attempts / seconds
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated at), least recently seen first
+
+    def take(self, key: str) -> float:
+        """Take a token for the key. Return 0 if there was one, otherwise the seconds until there is."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            # A dropped bucket starts full again, which only forgets keys that were idle the longest.
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class LoginLimiter:
+    """Per-IP and per-username login attempt limits."""
+
+    def __init__(self, username_rate: tuple = LOGIN_USERNAME_RATE, ip_rate: tuple = LOGIN_IP_RATE):
+        self.by_username = TokenBuckets(*username_rate)
+        self.by_ip = TokenBuckets(*ip_rate)
+        self.limited = 0
+
+    def retry_after(self, username: str, ip: str) -> int:
+        """Count a login attempt. Return 0 if it may go on, otherwise the seconds to wait before retrying."""
+        wait = self.by_ip.take(ip) or self.by_username.take(username.lower())
+        if wait:
+            self.limited += 1
+        return math.ceil(wait)
+
+
+cost_classes = {name: CostClass(name, limit, queue_size) for name, (limit, queue_size) in ADMISSION_LIMITS.items()}
+login_limiter = LoginLimiter()
@@ -1,22 +1,154 @@
+import atexit
+import contextvars
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler
 
-from constants import LOG_FILE, MAX_BYTES, BACKUP_COUNT
+from constants import (LOG_FILE, MAX_BYTES, BACKUP_COUNT, LOG_BATCH_SIZE, LOG_FORMAT, LOG_LEVEL, LOG_QUEUE_SIZE,
+                       LOG_SAMPLE_RATES)
+
+# Path of the request being served, set by the request middleware in main.
+current_route = contextvars.ContextVar("current_route", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line for log shippers."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "route": getattr(record, "route", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RouteSamplingFilter(logging.Filter):
+    """Keep only a share of the info and debug records of sampled routes. Warnings and errors are always kept."""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE_RATES.get(current_route.get(), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue the record as is, formatting happens in the writer thread instead of the request path."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.route = current_route.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler writing a batch of records with a single flush."""
+
+    def emit_batch(self, records):
+        try:
+            for record in records:
+                message = self.format(record) + self.terminator
+                if self.stream is None:
+                    self.stream = self._open()
+                # Same check as shouldRollover, without formatting the record a second time.
+                if self.maxBytes > 0 and self.stream.tell() + len(message) >= self.maxBytes:
+                    self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                self.stream.write(message)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+
+
+class LogWriter(threading.Thread):
+    """Background thread draining the log queue in batches."""
+
+    def __init__(self, log_queue, handler):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handler = handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            batch = [record]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.handler.emit_batch(batch)
+                    return
+                batch.append(record)
+            self.handler.emit_batch(batch)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        self.handler.close()
+
+
+class RouteContextMiddleware:
+    """ASGI middleware tagging log records with the path of the request being served."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = current_route.set(scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
 
 
 # Logging Configuration
 def setup_logging():
-    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if LOG_FORMAT == "json":
+        log_formatter = JsonFormatter()
+    else:
+        log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    # Create a file handler to store logs (with rotation)
-    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
+    # Create a file handler to store logs (with rotation), fed by a background writer thread
+    file_handler = BatchingRotatingFileHandler(LOG_FILE, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, delay=True)
     file_handler.setFormatter(log_formatter)
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    writer = LogWriter(log_queue, file_handler)
+    writer.start()
+    atexit.register(writer.stop)
+
+    # The request path only pays for a filter check and a queue put
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RouteSamplingFilter())
 
-    # Create a logger and set level to DEBUG (you can adjust it based on your needs)
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(file_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(queue_handler)
+    return queue_handler
 
 
 # Call setup_logging when the app starts
-setup_logging()
+queue_handler = setup_logging()
@@ -0,0 +1,90 @@
+# This is the asset read-through cache module.
+# Asset rows almost never change, so responses are serialized once and served with a strong ETag.
+
+import hashlib
+import time
+from typing import NamedTuple, Union
+
+import orjson
+from fastapi import Response, status
+from sqlalchemy import select
+
+from app_logger import logging
+from constants import ASSET_CACHE_TTL_SECONDS
+from models import Assets
+from schemas import AssetResponse
+
+# Only the columns of the response model are loaded, never a full entity.
+ASSET_COLUMNS = [getattr(Assets, name) for name in AssetResponse.model_fields]
+
+
+class CachedAsset(NamedTuple):
+    body: bytes
+    etag: str
+    loaded_at: float
+
+
+def serialize_asset(row) -> bytes:
+    if row is None:
+        return b"null"
+    return orjson.dumps(AssetResponse.model_construct(**row._mapping).model_dump())
+
+
+def etag_matches(if_none_match: Union[str, None], etag: str) -> bool:
+    """Return True if the If-None-Match header lists the ETag."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class AssetCache:
+    """Pre-serialized asset responses keyed by secrecy, reloaded after invalidation or TTL."""
+
+    def __init__(self, ttl: float = ASSET_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = {}  # is_secret -> CachedAsset
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    async def get(self, is_secret: bool, db) -> CachedAsset:
+        entry = self._entries.get(is_secret)
+        if entry is not None and time.time() - entry.loaded_at < self.ttl:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        logging.info("Loading asset data into the asset cache.")
+        row = (await db.execute(select(*ASSET_COLUMNS).filter(Assets.is_secret == is_secret))).first()
+        body = serialize_asset(row)
+        entry = CachedAsset(body, '"%s"' % hashlib.sha256(body).hexdigest()[:32], time.time())
+        self._entries[is_secret] = entry
+        return entry
+
+    def response(self, entry: CachedAsset, if_none_match: Union[str, None]) -> Response:
+        """Serve the cached body, or 304 Not Modified when the client already has it."""
+        headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(if_none_match, entry.etag):
+            self.not_modified += 1
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+    def invalidate(self):
+        """Drop every cached asset, called when asset rows change."""
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "max_age_seconds": max((now - entry.loaded_at for entry in self._entries.values()), default=0.0),
+        }
+
+
+asset_cache = AssetCache()
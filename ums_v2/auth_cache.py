@@ -0,0 +1,90 @@
+# This is the in-process authorization cache module.
+
+import threading
+import time
+from collections import OrderedDict
+
+from constants import AUTH_CACHE_MAX_SIZE
+
+
+class AuthCache:
+    """Bounded LRU cache of resolved token authorizations.
+
+    Entries are keyed by the raw bearer token and expire at the token's ``exp``
+    claim, so a stale token falls out of the cache on its own.
+    """
+
+    def __init__(self, max_size: int = AUTH_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # token -> (expires_at, username, value)
+        self._tokens_by_user = {}  # username -> set of cached tokens
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, token: str):
+        """Return the cached value for the token or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, username, value = entry
+            if expires_at <= time.time():
+                self._remove(token, username)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return value
+
+    def set(self, token: str, username: str, expires_at: float, value):
+        """Cache the value for the token until the given epoch timestamp."""
+        with self._lock:
+            if token in self._entries:
+                self._remove(token, self._entries[token][1])
+            self._entries[token] = (expires_at, username, value)
+            self._tokens_by_user.setdefault(username, set()).add(token)
+            while len(self._entries) > self.max_size:
+                old_token, (_, old_username, _) = next(iter(self._entries.items()))
+                self._remove(old_token, old_username)
+                self.evictions += 1
+
+    def invalidate_user(self, username: str):
+        """Drop every cached token of the user, e.g. after a role change."""
+        with self._lock:
+            for token in self._tokens_by_user.pop(username, ()):
+                self._entries.pop(token, None)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, token: str, username: str):
+        self._entries.pop(token, None)
+        tokens = self._tokens_by_user.get(username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[username]
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,311 @@
+# This is the shared authorization snapshot module.
+# With several uvicorn workers per host, one worker (elected with a file lock) keeps the RBAC index
+# fresh and writes it as flat int64 arrays to a file. Every worker maps that file read-only and answers
+# lookups straight from the mapping, so the snapshot is built once per host and its memory is shared.
+# A new generation is written to a temporary file and swapped in with os.replace, readers remap it
+# when the file changes and keep the old mapping until then.
+#
+# Layout: header, then the sections of SECTIONS in order, each padded to 8 bytes.
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Union
+
+from app_logger import logging
+from constants import AUTHZ_SNAPSHOT_CHECK_SECONDS, AUTHZ_SNAPSHOT_PATH, RBAC_REFRESH_SECONDS
+from rbac import ANY_ASSET, ANY_ASSET_NAME, asset_listeners, rbac_index, start_rbac_refresher, to_version
+
+MAGIC = b"UMSA"
+FORMAT_VERSION = 2
+# magic, format version, generation, built at, assets version, as of (the RbacIndex.as_of it was built from),
+# then the length of every section
+SECTIONS = (
+    "user_ids",  # sorted user ids
+    "user_versions",  # authorization version per user
+    "user_role_offsets",  # user i has the roles user_role_ids[offsets[i]:offsets[i + 1]]
+    "user_role_ids",
+    "role_ids",  # sorted role ids
+    "role_mask_offsets",  # role i has the masks at [offsets[i]:offsets[i + 1]] of the next two
+    "role_mask_assets",
+    "role_mask_values",
+    "name_users",  # index into user_ids of the users sorted by name
+    "name_offsets",  # name k is names[name_offsets[k]:name_offsets[k + 1]]
+    "names",  # bytes
+    "meta",  # bytes, json {"roles": {id: name}, "assets": {id: name}}
+)
+HEADER = struct.Struct("<4sIQdqq" + "q" * len(SECTIONS))
+
+
+def _padded(length: int) -> int:
+    return (length + 7) & ~7
+
+
+def serialize(content: dict, generation: int) -> bytes:
+    """Serialize an RbacIndex.export() into the snapshot layout."""
+    user_ids = sorted(set(content["user_roles"]) | set(content["user_versions"]))
+    user_role_offsets, user_role_ids = array("q", [0]), array("q")
+    for user_id in user_ids:
+        user_role_ids.extend(sorted(content["user_roles"].get(user_id, ())))
+        user_role_offsets.append(len(user_role_ids))
+    role_ids = sorted(content["role_masks"])
+    role_mask_offsets, role_mask_assets, role_mask_values = array("q", [0]), array("q"), array("q")
+    for role_id in role_ids:
+        for asset_id, mask in sorted(content["role_masks"][role_id].items()):
+            role_mask_assets.append(asset_id)
+            role_mask_values.append(mask)
+        role_mask_offsets.append(len(role_mask_assets))
+    user_positions = {user_id: position for position, user_id in enumerate(user_ids)}
+    named = sorted((username.encode(), user_positions[user_id]) for username, user_id in content["user_ids"].items()
+                   if user_id in user_positions)
+    name_offsets, names = array("q", [0]), bytearray()
+    for name, _ in named:
+        names += name
+        name_offsets.append(len(names))
+    meta = json.dumps({"roles": content["role_names"], "assets": content["asset_names"]}).encode()
+
+    sections = {
+        "user_ids": array("q", user_ids),
+        "user_versions": array("q", (content["user_versions"].get(user_id, 0) for user_id in user_ids)),
+        "user_role_offsets": user_role_offsets,
+        "user_role_ids": user_role_ids,
+        "role_ids": array("q", role_ids),
+        "role_mask_offsets": role_mask_offsets,
+        "role_mask_assets": role_mask_assets,
+        "role_mask_values": role_mask_values,
+        "name_users": array("q", (position for _, position in named)),
+        "name_offsets": name_offsets,
+        "names": bytes(names),
+        "meta": meta,
+    }
+    payload = [bytes(sections[name]) for name in SECTIONS]
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, generation, time.time(), content["assets_version"], content["as_of"],
+                         *(len(data) for data in payload))
+    return b"".join(data + b"\0" * (_padded(len(data)) - len(data)) for data in [header] + payload)
+
+
+def write_snapshot(path: str, content: dict, generation: int):
+    """Write a generation next to the snapshot and swap it in atomically."""
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(serialize(content, generation))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+
+class Snapshot:
+    """One mapped generation, every section is a zero-copy view on the mapping."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            self._mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mapping)
+        magic, format_version, self.generation, self.built_at, self.assets_version, self.as_of, *lengths = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not an authorization snapshot of format {FORMAT_VERSION}.")
+        offset = _padded(HEADER.size)
+        for name, length in zip(SECTIONS, lengths):
+            section = view[offset:offset + length]
+            setattr(self, name, section if name in ("names", "meta") else section.cast("q"))
+            offset += _padded(length)
+        meta = json.loads(bytes(self.meta))
+        self.role_names = {int(role_id): name for role_id, name in meta["roles"].items()}
+        self.asset_names = {int(asset_id): name for asset_id, name in meta["assets"].items()}
+
+    def user_position(self, user_id: int) -> Union[int, None]:
+        position = bisect.bisect_left(self.user_ids, user_id)
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position
+        return None
+
+    def user_id(self, username: str) -> Union[int, None]:
+        target = username.encode()
+        low, high = 0, len(self.name_users)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.names[self.name_offsets[middle]:self.name_offsets[middle + 1]]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.name_users) and \
+                bytes(self.names[self.name_offsets[low]:self.name_offsets[low + 1]]) == target:
+            return self.user_ids[self.name_users[low]]
+        return None
+
+    def user_roles(self, position: int) -> frozenset:
+        return frozenset(self.user_role_ids[self.user_role_offsets[position]:self.user_role_offsets[position + 1]])
+
+    def role_masks(self, role_id: int):
+        """Yield (asset_id, mask) granted by the role."""
+        position = bisect.bisect_left(self.role_ids, role_id)
+        if position < len(self.role_ids) and self.role_ids[position] == role_id:
+            for index in range(self.role_mask_offsets[position], self.role_mask_offsets[position + 1]):
+                yield self.role_mask_assets[index], self.role_mask_values[index]
+
+
+class SnapshotIndex:
+    """Read side of the shared snapshot, answering the same lookups as the RbacIndex.
+    Role assignments made by this worker are overlaid until a snapshot as of a later database time is mapped,
+    which has them, or has them removed again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._snapshot = None
+        self._file_id = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._granted_roles = {}  # user_id -> role ids assigned by this worker
+        self._granted_versions = {}  # user_id -> version after the assignment
+        self._granted_at = {}  # user_id -> version of the latest assignment's updated_at
+
+    @property
+    def ready(self) -> bool:
+        return self._current() is not None
+
+    def _current(self) -> Union[Snapshot, None]:
+        now = time.monotonic()
+        if now - self._checked_at >= AUTHZ_SNAPSHOT_CHECK_SECONDS:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self._snapshot
+            if (stat.st_ino, stat.st_mtime_ns) != self._file_id:
+                self._remap((stat.st_ino, stat.st_mtime_ns))
+        return self._snapshot
+
+    def _remap(self, file_id):
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError) as error:
+            logging.error("Error in mapping the authorization snapshot: %s", error)
+            return
+        previous, self._snapshot, self._file_id = self._snapshot, snapshot, file_id
+        with self._lock:
+            for user_id, granted_at in list(self._granted_at.items()):
+                if snapshot.as_of > granted_at:
+                    del self._granted_at[user_id]
+                    self._granted_versions.pop(user_id, None)
+                    self._granted_roles.pop(user_id, None)
+        if previous is not None and previous.assets_version != snapshot.assets_version:
+            for listener in asset_listeners:
+                listener()
+
+    def user_roles(self, username: str):
+        """Return (user_id, role_ids, role_names) for a user with roles, or None if not in the snapshot."""
+        snapshot = self._current()
+        user_id = snapshot.user_id(username) if snapshot is not None else None
+        if user_id is None:
+            return None
+        role_ids = snapshot.user_roles(snapshot.user_position(user_id)) | self._granted_roles.get(user_id, frozenset())
+        return user_id, role_ids, self.role_names(role_ids)
+
+    def role_names(self, role_ids) -> frozenset:
+        snapshot = self._current()
+        role_names = snapshot.role_names if snapshot is not None else {}
+        return frozenset(role_names.get(role_id) for role_id in role_ids)
+
+    def user_version(self, user_id: int):
+        """Return the user's authorization version, or None while no snapshot is mapped."""
+        snapshot = self._current()
+        if snapshot is None:
+            return None
+        position = snapshot.user_position(user_id)
+        version = snapshot.user_versions[position] if position is not None else 0
+        return max(version, self._granted_versions.get(user_id, 0))
+
+    def user_role_ids(self, user_id: int) -> frozenset:
+        """Role ids the user holds now, including the ones this worker granted."""
+        snapshot = self._current()
+        position = snapshot.user_position(user_id) if snapshot is not None else None
+        role_ids = snapshot.user_roles(position) if position is not None else frozenset()
+        return role_ids | self._granted_roles.get(user_id, frozenset())
+
+    def asset_masks(self, role_ids) -> dict:
+        """Return the merged {asset_name: action bitmask} granted by the roles."""
+        snapshot = self._current()
+        if snapshot is None:
+            return {}
+        merged = {}
+        for role_id in role_ids:
+            for asset_id, mask in snapshot.role_masks(role_id):
+                asset_name = ANY_ASSET_NAME if asset_id == ANY_ASSET else snapshot.asset_names.get(asset_id)
+                if asset_name is not None:
+                    merged[asset_name] = merged.get(asset_name, 0) | mask
+        return merged
+
+    def grant(self, user_id: int, username: str, role_id: int, granted_at: datetime):
+        """Record a role assignment made by this worker without waiting for the next snapshot.
+        granted_at is the updated_at of the inserted user_roles row.
+        """
+        # Outside the lock, user_version() may remap, which takes it.
+        version = max((self.user_version(user_id) or 0) + 1, to_version(granted_at))
+        with self._lock:
+            # Users not in the snapshot are still resolved from db by user_roles(), this only keeps their
+            # tokens current.
+            self._granted_roles[user_id] = self._granted_roles.get(user_id, frozenset()) | {role_id}
+            self._granted_versions[user_id] = max(self._granted_versions.get(user_id, 0), version)
+            self._granted_at[user_id] = max(self._granted_at.get(user_id, 0), to_version(granted_at))
+
+
+_leader_lock_files = []
+
+
+def _elect_and_refresh(stop: threading.Event, path: str):
+    """Wait for the snapshot lock, then keep the RBAC index fresh and write a generation on every change."""
+    import fcntl  # Unix only, like running several workers behind one lock file.
+
+    lock_file = open(f"{path}.lock", "a")
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if stop.wait(RBAC_REFRESH_SECONDS):
+                lock_file.close()
+                return
+    logging.info("This worker builds the authorization snapshot %s.", path)
+    written = {"revision": None, "generation": 0}
+    try:
+        written["generation"] = Snapshot(path).generation
+    except (OSError, ValueError):
+        pass
+
+    def write_if_changed():
+        content = rbac_index.export()
+        if not rbac_index.ready or content["revision"] == written["revision"]:
+            return
+        written["generation"] += 1
+        write_snapshot(path, content, written["generation"])
+        written["revision"] = content["revision"]
+        logging.info("Authorization snapshot generation %s written.", written["generation"])
+
+    # The lock is held as long as the file stays open, so for the life of the process.
+    _leader_lock_files.append(lock_file)
+    start_rbac_refresher(on_refresh=write_if_changed, stop=stop)
+
+
+def start_authz_refresher() -> threading.Event:
+    """Start keeping the authorization data fresh. Set the returned event to stop it.
+    Without a snapshot path every worker keeps its own RBAC index, otherwise one worker per host
+    writes the shared snapshot and the others only map it.
+    """
+    if not AUTHZ_SNAPSHOT_PATH:
+        return start_rbac_refresher()
+    stop = threading.Event()
+    threading.Thread(target=_elect_and_refresh, args=(stop, AUTHZ_SNAPSHOT_PATH), name="authz-snapshot",
+                     daemon=True).start()
+    return stop
+
+
+# The index the authorization code reads from.
+authz_index = SnapshotIndex(AUTHZ_SNAPSHOT_PATH) if AUTHZ_SNAPSHOT_PATH else rbac_index
@@ -0,0 +1,198 @@
+# This is the streaming bulk user import module.
+# The upload is spooled to a temporary file, then parsed, hashed and inserted
+# batch by batch, so memory stays flat whatever the size of the upload.
+
+import csv
+import json
+import tempfile
+from typing import AsyncIterator
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+
+from app_logger import logging
+from constants import BULK_IMPORT_BATCH_SIZE, BULK_IMPORT_SPOOL_BYTES
+from container import AsyncSessionLocal, upsert_insert
+from models import Users
+from password_pool import password_pool
+from schemas import User
+
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+
+
+async def spool_upload(chunks: AsyncIterator[bytes]):
+    """Copy the request body into a temporary file that moves to disk past BULK_IMPORT_SPOOL_BYTES.
+    The body has to be read before the response starts streaming, because the streaming
+    response listens for client disconnects on the same receive channel.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=BULK_IMPORT_SPOOL_BYTES)
+    async for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+async def iter_spool(spool, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Read the spooled upload back in chunks and close it when done."""
+    try:
+        while chunk := spool.read(chunk_size):
+            yield chunk
+    finally:
+        spool.close()
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into decoded lines without buffering the whole body."""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8").rstrip("\r")
+
+
+async def iter_csv_rows(lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+    """Yield (line_number, values) per CSV row, values is None when the row cannot be parsed.
+    A quoted field may hold newlines, so lines are joined until their quotes balance before csv.reader
+    parses them. The line number is the row's first line.
+    """
+    row, quotes, first_line, line_number = [], 0, 0, 0
+    async for line in lines:
+        line_number += 1
+        if not row:
+            if not line.strip():
+                continue
+            first_line = line_number
+        row.append(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        yield first_line, _parse_csv_row(row)
+        row, quotes = [], 0
+    if row:
+        # Unterminated quote at the end of the upload.
+        yield first_line, None
+
+
+def _parse_csv_row(lines: list):
+    try:
+        return next(csv.reader(["\n".join(lines)], strict=True))
+    except csv.Error:
+        return None
+
+
+async def iter_records(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[tuple]:
+    """Yield (line_number, record) for NDJSON or CSV (with a header row) uploads.
+    The record is None when the row cannot be parsed.
+    """
+    lines = iter_lines(chunks)
+    if content_type.split(";")[0].strip() in CSV_CONTENT_TYPES:
+        header = None
+        async for line_number, values in iter_csv_rows(lines):
+            if header is None:
+                header = [name.strip() for name in values or ()]
+                continue
+            yield line_number, dict(zip(header, values)) if values is not None and len(values) == len(header) \
+                else None
+        return
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+
+async def _import_batch(db, batch: list) -> list:
+    """Insert one batch of (line_number, record) and return the per-row results."""
+    results = {}
+    users = {}
+    usernames = set()
+    for line_number, record in batch:
+        try:
+            user = User(**record) if record is not None else None
+        except ValidationError as error:
+            user = None
+            results[line_number] = {"line": line_number, "status": "invalid",
+                                    "detail": error.errors(include_url=False)[0]["msg"]}
+        if user is None:
+            results.setdefault(line_number, {"line": line_number, "status": "invalid",
+                                             "detail": "Row could not be parsed."})
+        elif user.username in usernames:
+            results[line_number] = {"line": line_number, "username": user.username, "status": "duplicate"}
+        else:
+            users[line_number] = user
+            usernames.add(user.username)
+
+    if users:
+        hashed_passwords = await password_pool.hash_many([user.password for user in users.values()])
+        rows = [{"username": user.username, "password": hashed_password, "email": user.email}
+                for user, hashed_password in zip(users.values(), hashed_passwords)]
+        failed = set()
+        try:
+            created = set((await db.execute(
+                upsert_insert(Users).values(rows).on_conflict_do_nothing().returning(Users.username))).scalars())
+            await db.commit()
+        except SQLAlchemyError as error:
+            await db.rollback()
+            logging.error("Bulk import batch failed, inserting its rows one by one: %s", error)
+            created, failed = await _insert_one_by_one(db, rows)
+        for line_number, user in users.items():
+            if user.username in failed:
+                results[line_number] = {"line": line_number, "username": user.username, "status": "error",
+                                        "detail": "Row could not be stored."}
+            else:
+                results[line_number] = {"line": line_number, "username": user.username,
+                                        "status": "created" if user.username in created else "duplicate"}
+    return [results[line_number] for line_number, _ in batch]
+
+
+async def _insert_one_by_one(db, rows: list) -> tuple:
+    """Insert rows in their own transactions, return the (created, failed) usernames."""
+    created, failed = set(), set()
+    for row in rows:
+        try:
+            username = await db.scalar(
+                upsert_insert(Users).values(row).on_conflict_do_nothing().returning(Users.username))
+            await db.commit()
+        except SQLAlchemyError as error:
+            await db.rollback()
+            logging.error("Bulk import row of %s failed: %s", row["username"], error)
+            failed.add(row["username"])
+            continue
+        if username is not None:
+            created.add(username)
+    return created, failed
+
+
+async def import_users(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[str]:
+    """Import users from the uploaded stream and yield one NDJSON result line per row.
+    The summary line always comes last, when the import stops early it says so.
+    """
+    summary = {"created": 0, "duplicate": 0, "invalid": 0, "error": 0}
+    try:
+        async with AsyncSessionLocal() as db:
+            batch = []
+            async for line_number, record in iter_records(chunks, content_type):
+                batch.append((line_number, record))
+                if len(batch) < BULK_IMPORT_BATCH_SIZE:
+                    continue
+                for result in await _import_batch(db, batch):
+                    summary[result["status"]] += 1
+                    yield json.dumps(result) + "\n"
+                batch = []
+            if batch:
+                for result in await _import_batch(db, batch):
+                    summary[result["status"]] += 1
+                    yield json.dumps(result) + "\n"
+    except Exception as error:
+        logging.error("Bulk import stopped: %s", error)
+        summary["detail"] = "Import stopped, rows without a result were not imported."
+    logging.info("Bulk import finished: %s", summary)
+    yield json.dumps({"summary": summary}) + "\n"
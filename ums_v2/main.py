@@ -1,164 +1,392 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
+from typing import Optional, Union
 
-from container import get_db
-from app_logger import logging
-from models import Users, Assets, UserRoles, Roles
-from schemas import User, UserLogin, AssignUserRole
-from user_auth import get_password_hash, verify_password, create_access_token, get_permission
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, status, Request
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
-app = FastAPI()
+from admission import AdmissionMiddleware, cost_classes, login_limiter
+from constants import BULK_ASSIGN_CHUNK_SIZE, FORWARDED_ALLOW_IPS, READ_YOUR_WRITES_COOKIE, READ_YOUR_WRITES_SECONDS
+from container import async_engine, get_async_db, get_read_db, replica_engines, upsert_insert
+from app_logger import RouteContextMiddleware, logging
+from asset_cache import asset_cache
+from auth_cache import auth_cache
+from bulk_import import import_users, iter_spool, spool_upload
+from metrics import MetricsMiddleware, collect_admission, collect_caches, collect_password_pool, collect_pools, \
+    instrument_engine, registry, render_gauges
+from models import Users, UserRoles, Roles
+from password_pool import PasswordPoolFull, password_pool
+from authz_snapshot import authz_index, start_authz_refresher
+from rbac import asset_listeners
+from revocation import revocations, revoke_access_token, start_revocation_sync
+from schemas import User, UserLogin, AssignUserRole, AuthzCheck, BulkAssignUserRoles, RefreshToken, RevokeToken, \
+    Logout, AssetResponse, AuthzCheckResponse, AuthzCheckResult, BulkAssignResponse, BulkAssignResult, \
+    MessageResponse, RevokeResponse, RoleAssignmentResponse, TokenResponse
+from sessions import create_session, revoke_session, rotate_session, start_session_purger
+from shared import ReadYourWritesMiddleware, fast_response
+from user_auth import get_password_hash_async, verify_password_async, create_access_token, decode_access_token, \
+    get_permission, get_user_access, check_access, load_user_access, access_claims, password_needs_update, \
+    rehash_password
 
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(ReadYourWritesMiddleware, cookie_name=READ_YOUR_WRITES_COOKIE,
+                   sticky_seconds=READ_YOUR_WRITES_SECONDS)
+app.add_middleware(RouteContextMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+if FORWARDED_ALLOW_IPS:
+    # Outermost, so the login rate limits and the logs see the client address the trusted proxies forwarded.
+    app.add_middleware(ProxyHeadersMiddleware, trusted_hosts=FORWARDED_ALLOW_IPS)
 
-@app.get("/healthcheck")
+for engine in [async_engine] + replica_engines:
+    instrument_engine(engine.sync_engine)
+registry.collectors += [
+    collect_pools({"primary": async_engine.sync_engine,
+                   **{f"replica{index}": replica.sync_engine for index, replica in enumerate(replica_engines)}}),
+    collect_password_pool(password_pool),
+    collect_caches({"auth": auth_cache, "asset": asset_cache}),
+    collect_admission(cost_classes, login_limiter),
+    lambda: render_gauges("ums_revoked_tokens", "Revoked access tokens not expired yet.", {(): len(revocations)}),
+]
+
+
+@app.on_event("startup")
+def startup_event():
+    """Compile the RBAC index before serving traffic and keep it refreshed."""
+    asset_listeners.append(asset_cache.invalidate)
+    app.state.rbac_refresher = start_authz_refresher()
+    app.state.session_purger = start_session_purger()
+    app.state.revocation_sync = start_revocation_sync()
+    password_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    app.state.rbac_refresher.set()
+    app.state.session_purger.set()
+    app.state.revocation_sync.set()
+    password_pool.shutdown()
+
+
+def password_pool_full(error: PasswordPoolFull):
+    logging.error("Password pool is full: %s", error)
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Server is busy, please retry.", headers={"Retry-After": "1"})
+
+
+@app.get("/healthcheck", response_model=MessageResponse)
 def read_root():
     return {"message": "heathcheck: Everything looks good!"}
 
 
-@app.post("/users/v1/register")
-def register(user: User, db: Session = Depends(get_db)):
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Metrics in the Prometheus text exposition format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.post("/users/v1/register", response_model=MessageResponse)
+async def register(user: User, db: AsyncSession = Depends(get_async_db)):
     try:
-        logging.info(f"Registration for user '{user.username}' starts.")
-        logging.info(f"Checking if username already exists.")
-        user_obj = db.query(Users).filter(Users.username == user.username).first()
-        if user_obj:
-            logging.error(f"User '{user.username}' already exists.")
+        logging.info("Registration for user '%s' starts.", user.username)
+        logging.info("Checking if username already exists.")
+        user_id = await db.scalar(select(Users.user_id).filter(Users.username == user.username))
+        if user_id is not None:
+            logging.error("User '%s' already exists.", user.username)
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash_async(user.password)
         user.password = hashed_password
-        logging.info(f"Start storing user details in the users table for '{user.username}'.")
+        logging.info("Start storing user details in the users table for '%s'.", user.username)
         user_obj = Users(**user.dict())
         db.add(user_obj)
-        db.commit()
-        logging.info(f"User '{user.username}' registered successfully!")
-        return {"message": "User registered successfully"}
+        await db.commit()
+        logging.info("User '%s' registered successfully!", user.username)
+        return fast_response(MessageResponse, message="User registered successfully")
     except HTTPException as error:
         return {"message": str(error)}
+    except PasswordPoolFull as error:
+        raise password_pool_full(error)
     except Exception as error:
-        logging.error(f"Error while storing '{user.username}': {str(error)}")
+        logging.error("Error while storing '%s': %s", user.username, error)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=str(error))
 
 
-@app.post("/users/v1/login")
-def login(user: UserLogin, db: Session = Depends(get_db)):
+@app.post("/users/v1/login", response_model=Union[TokenResponse, MessageResponse])
+async def login(request: Request, user: UserLogin, background_tasks: BackgroundTasks,
+                db: AsyncSession = Depends(get_async_db)):
+    # Before any lookup, so credential stuffing is turned away without burning a password verification.
+    retry_after = login_limiter.retry_after(user.username, request.client.host if request.client else "")
+    if retry_after:
+        logging.error("Too many login attempts for user '%s', rejecting.", user.username)
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many login attempts, please retry later.",
+                            headers={"Retry-After": str(retry_after)})
     try:
-        logging.info(f"Trying to login user '{user.username}'.")
-        logging.info(f"Checking user '{user.username}' in the database.")
-        user_obj = db.query(Users).filter(Users.username == user.username).first()
-        if not user_obj:
-            logging.error(f"User '{user.username}' not found.")
+        logging.info("Trying to login user '%s'.", user.username)
+        logging.info("Checking user '%s' in the database.", user.username)
+        user_obj = (await db.execute(
+            select(Users.user_id, Users.password).filter(Users.username == user.username))).first()
+        if user_obj is None:
+            logging.error("User '%s' not found.", user.username)
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Username not registered")
-        if not user_obj.password or not verify_password(user.password, user_obj.password):
-            logging.error(f"Credentials not correct for user '{user.username}'")
+        if not user_obj.password or not await verify_password_async(user.password, user_obj.password):
+            logging.error("Credentials not correct for user '%s'", user.username)
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-        logging.info(f"User credentials are correct. Creating bearer token.")
-        access_token = create_access_token(data={"sub": user.username})
-        logging.info(f"User {user.username} logged in successfully.")
-        return {"access_token": access_token, "token_type": "bearer"}
+        if password_needs_update(user_obj.password):
+            logging.info("Password hash of user '%s' predates the hash policy, rehashing it.", user.username)
+            background_tasks.add_task(rehash_password, user_obj.user_id, user_obj.password, user.password)
+        logging.info("User credentials are correct. Creating bearer token.")
+        user_access = await load_user_access(user.username, db)
+        access_token = create_access_token(data={"sub": user.username, **access_claims(user_access)})
+        logging.info("Opening a refresh token session for user '%s'.", user.username)
+        refresh_token = await create_session(user_obj.user_id, db)
+        logging.info("User %s logged in successfully.", user.username)
+        return fast_response(TokenResponse, access_token=access_token, token_type="bearer", refresh_token=refresh_token)
     except HTTPException as error:
         return {"message": str(error)}
+    except PasswordPoolFull as error:
+        raise password_pool_full(error)
     except Exception as error:
-        logging.error(f"Error while logging {user.username} in: {str(error)}")
+        logging.error("Error while logging %s in: %s", user.username, error)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=str(error))
 
 
-@app.post("/assign_role")
-async def role_assignment(request: Request, user_request: AssignUserRole, db: Session = Depends(get_db)):
+@app.post("/users/v1/token/refresh", response_model=TokenResponse)
+async def refresh(token_request: RefreshToken, db: AsyncSession = Depends(get_async_db)):
+    """This API will exchange a refresh token for a new access token and a new refresh token,
+    without verifying the password again.
+    """
+    logging.info("Refreshing tokens.")
+    rotated = await rotate_session(token_request.refresh_token, db)
+    if rotated is None:
+        logging.error("Refresh token is invalid, expired or revoked.")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token!")
+    user_id, refresh_token = rotated
+    user_obj = (await db.execute(select(Users.username, Users.status).filter(Users.user_id == user_id))).first()
+    if user_obj is None or user_obj.status != "active":
+        logging.error("User %s is no longer active, revoking the session.", user_id)
+        await revoke_session(refresh_token, db, all_sessions=True)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token!")
+    user_access = await load_user_access(user_obj.username, db)
+    access_token = create_access_token(data={"sub": user_obj.username, **access_claims(user_access)})
+    logging.info("Tokens of user %s refreshed.", user_obj.username)
+    return fast_response(TokenResponse, access_token=access_token, token_type="bearer", refresh_token=refresh_token)
+
+
+@app.post("/users/v1/token/revoke", response_model=RevokeResponse)
+async def revoke(token_request: RevokeToken, db: AsyncSession = Depends(get_async_db)):
+    """This API will revoke the session of a refresh token, or every session of its user."""
+    logging.info("Revoking refresh token session.")
+    revoked = await revoke_session(token_request.refresh_token, db, token_request.all_sessions)
+    logging.info("%s sessions revoked.", revoked)
+    return fast_response(RevokeResponse, revoked=revoked)
+
+
+@app.post("/users/v1/logout", response_model=MessageResponse)
+async def logout(request: Request, logout_request: Optional[Logout] = None, db: AsyncSession = Depends(get_async_db)):
+    """This API will revoke the bearer access token, and the refresh token session if one is given."""
+    token = (request.headers.get("authorization") or "").replace("Bearer ", "")
+    decoded_token = decode_access_token(token) if token else None
+    if not decoded_token or not decoded_token.get("jti"):
+        logging.error("Logout without a valid token.")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token!")
+    logging.info("Logging out user %s.", decoded_token.get("sub"))
+    await revoke_access_token(decoded_token["jti"], decoded_token["exp"], db)
+    if logout_request is not None and logout_request.refresh_token:
+        await revoke_session(logout_request.refresh_token, db)
+    logging.info("User %s logged out.", decoded_token.get("sub"))
+    return fast_response(MessageResponse, message="Logged out successfully")
+
+
+@app.post("/assign_role", response_model=RoleAssignmentResponse)
+async def role_assignment(request: Request, user_request: AssignUserRole, db: AsyncSession = Depends(get_async_db)):
     """This API will assign the provided role to provided user."""
     try:
-        logging.info(f"Assigning role to user.")
-        logging.info(f"Checking if session user has permission to assign role.")
-        is_permitted = get_permission(request.headers.get("authorization"), 'admin', db)
+        logging.info("Assigning role to user.")
+        logging.info("Checking if session user has permission to assign role.")
+        is_permitted = await get_permission(request.headers.get("authorization"), 'admin', db)
         if not is_permitted:
             logging.error("Session user is not permitted to assign roles.")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail="Access denied!")
-        logging.info(f"Fetching data for user {user_request.user_id}.")
-        user = db.query(Users).filter(Users.user_id == user_request.user_id).first()
-        if not user:
-            logging.error(f"User not found.")
+        logging.info("Fetching data for user %s.", user_request.user_id)
+        username = await db.scalar(select(Users.username).filter(Users.user_id == user_request.user_id))
+        if username is None:
+            logging.error("User not found.")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"User not found!")
-        logging.info(f"Fetching data for role {user_request.role_id}.")
-        role = db.query(Roles).filter(Roles.role_id == user_request.role_id).first()
-        if not role:
+        logging.info("Fetching data for role %s.", user_request.role_id)
+        role_name = await db.scalar(select(Roles.role_name).filter(Roles.role_id == user_request.role_id))
+        if role_name is None:
             logging.error("Role not found.")
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Role not found!")
-        logging.info(f"Checking if role {role.role_name} to user {user.username} already assigned.")
-        user_role = db.query(UserRoles).\
-            filter(UserRoles.user_id == user_request.user_id).\
-            filter(UserRoles.role_id == user_request.role_id).first()
-        if user_role:
-            logging.error(f"Role {role.role_name} already assigned to user {user.username}")
-            return {
-                "user_name": user.username,
-                "role": role.role_name,
-                "message": f"Role already has been assigned!"
-            }
-        logging.info(f"Assigning Role {role.role_name} to user {user.username}.")
-        user_role = UserRoles(**{"user_id": user.user_id, "role_id": role.role_id})
-        db.add(user_role)
-        db.commit()
-        db.refresh(user_role)
-        logging.info(f"Role {role.role_name} assigned to user {user.username}")
-        return {
-            "user_name": user.username,
-            "role": role.role_name,
-            "message": f"Role {role.role_name} has been assigned to the user {user.username} successfully!"
-        }
+        logging.info("Checking if role %s to user %s already assigned.", role_name, username)
+        user_role = await db.scalar(
+            select(UserRoles.user_id).
+            filter(UserRoles.user_id == user_request.user_id).
+            filter(UserRoles.role_id == user_request.role_id))
+        if user_role is not None:
+            logging.error("Role %s already assigned to user %s", role_name, username)
+            return fast_response(RoleAssignmentResponse, user_name=username, role=role_name,
+                                 message="Role already has been assigned!")
+        logging.info("Assigning Role %s to user %s.", role_name, username)
+        granted_at = await db.scalar(
+            insert(UserRoles).values(user_id=user_request.user_id, role_id=user_request.role_id).
+            returning(UserRoles.updated_at))
+        await db.commit()
+        authz_index.grant(user_request.user_id, username, user_request.role_id, granted_at)
+        auth_cache.invalidate_user(username)
+        logging.info("Role %s assigned to user %s", role_name, username)
+        return fast_response(
+            RoleAssignmentResponse, user_name=username, role=role_name,
+            message=f"Role {role_name} has been assigned to the user {username} successfully!")
     except HTTPException as error:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
     except Exception as error:
-        logging.error(f"Error in assigning role {user_request.role_id} to user {user_request.user_id}: {str(error)}")
+        logging.error("Error in assigning role %s to user %s: %s", user_request.role_id, user_request.user_id, error)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(error)
         )
 
 
-@app.get("/assets/v1/business")
-def get_business(request: Request, db: Session = Depends(get_db)):
+async def fetch_names(db: AsyncSession, id_column, name_column, ids: set) -> dict:
+    """Map the ids that exist to their names, BULK_ASSIGN_CHUNK_SIZE ids per IN (...) query."""
+    ids = list(ids)
+    names = {}
+    for start in range(0, len(ids), BULK_ASSIGN_CHUNK_SIZE):
+        names.update((await db.execute(
+            select(id_column, name_column).filter(id_column.in_(ids[start:start + BULK_ASSIGN_CHUNK_SIZE])))).all())
+    return names
+
+
+@app.post("/assign_role/bulk", response_model=BulkAssignResponse)
+async def bulk_role_assignment(request: Request, user_request: BulkAssignUserRoles,
+                               db: AsyncSession = Depends(get_async_db)):
+    """This API will assign many roles to many users in one transaction and report the outcome per pair."""
+    pairs = list(dict.fromkeys(
+        [(assignment.user_id, assignment.role_id) for assignment in user_request.assignments] +
+        [(user_id, user_request.role_id) for user_id in user_request.user_ids]))
+    try:
+        logging.info("Assigning %s roles in bulk.", len(pairs))
+        is_permitted = await get_permission(request.headers.get("authorization"), 'admin', db)
+        if not is_permitted:
+            logging.error("Session user is not permitted to assign roles.")
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail="Access denied!")
+        logging.info("Fetching users and roles of the requested assignments.")
+        usernames = await fetch_names(db, Users.user_id, Users.username, {user_id for user_id, _ in pairs})
+        role_names = await fetch_names(db, Roles.role_id, Roles.role_name, {role_id for _, role_id in pairs})
+        valid_pairs = [(user_id, role_id) for user_id, role_id in pairs
+                       if user_id in usernames and role_id in role_names]
+        assigned = {}  # (user_id, role_id) -> updated_at of the inserted row
+        for start in range(0, len(valid_pairs), BULK_ASSIGN_CHUNK_SIZE):
+            rows = [{"user_id": user_id, "role_id": role_id}
+                    for user_id, role_id in valid_pairs[start:start + BULK_ASSIGN_CHUNK_SIZE]]
+            assigned.update(((user_id, role_id), granted_at) for user_id, role_id, granted_at in (await db.execute(
+                upsert_insert(UserRoles).values(rows).on_conflict_do_nothing().
+                returning(UserRoles.user_id, UserRoles.role_id, UserRoles.updated_at))).all())
+        await db.commit()
+        for (user_id, role_id), granted_at in assigned.items():
+            authz_index.grant(user_id, usernames[user_id], role_id, granted_at)
+            auth_cache.invalidate_user(usernames[user_id])
+        logging.info("%s of %s roles assigned in bulk.", len(assigned), len(pairs))
+
+        results = []
+        for user_id, role_id in pairs:
+            if user_id not in usernames:
+                outcome = "user_not_found"
+            elif role_id not in role_names:
+                outcome = "role_not_found"
+            elif (user_id, role_id) in assigned:
+                outcome = "assigned"
+            else:
+                outcome = "already_assigned"
+            results.append(BulkAssignResult.model_construct(user_id=user_id, role_id=role_id, status=outcome))
+        return fast_response(BulkAssignResponse, assigned=len(assigned), results=results)
+    except HTTPException:
+        raise
+    except Exception as error:
+        logging.error("Error in assigning roles in bulk: %s", error)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(error)
+        )
+
+
+@app.get("/assets/v1/business", response_model=Union[AssetResponse, MessageResponse])
+async def get_business(request: Request, db: AsyncSession = Depends(get_read_db)):
     try:
         logging.info("Getting secret business data.")
         logging.info("Checking if the session user is permitted to read business data.")
-        is_permitted = get_permission(request.headers.get('authorization'), "admin", db)
+        is_permitted = await get_permission(request.headers.get('authorization'), "admin", db)
         if not is_permitted:
             logging.error("Session user is not permitted to read business data.")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                           detail="Access denied!")
-        logging.info("Fetching business data from db.")
-        business_data = db.query(Assets).filter(Assets.is_secret == True).first()
+        logging.info("Fetching business data from the asset cache.")
+        business_data = await asset_cache.get(True, db)
         logging.info("Returning business data.")
-        return business_data
+        return asset_cache.response(business_data, request.headers.get("if-none-match"))
     except HTTPException as error:
         return {"message": str(error)}
     except Exception as error:
-        logging.error(f"Error in fetching business data: {str(error)}")
+        logging.error("Error in fetching business data: %s", error)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=str(error))
 
 
-@app.get("/assets/v1/marketing")
-def get_marketing(request: Request, db: Session = Depends(get_db)):
+@app.get("/assets/v1/marketing", response_model=Union[AssetResponse, MessageResponse])
+async def get_marketing(request: Request, db: AsyncSession = Depends(get_read_db)):
     try:
         logging.info("Getting Marketing data.")
         logging.info("Checking if the session user is permitted to read marketing data.")
-        is_permitted = get_permission(request.headers.get('authorization'), "staff", db)
+        is_permitted = await get_permission(request.headers.get('authorization'), "staff", db)
         if not is_permitted:
             logging.error("Session user is not permitted to read marketing data.")
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                                 detail="Access denied!")
-        logging.info("Fetching business data from db.")
-        business_data = db.query(Assets).filter(Assets.is_secret == False).first()
+        logging.info("Fetching business data from the asset cache.")
+        business_data = await asset_cache.get(False, db)
         logging.info("Returning business data.")
-        return business_data
+        return asset_cache.response(business_data, request.headers.get("if-none-match"))
     except HTTPException as error:
         return {"message": str(error)}
     except Exception as error:
-        logging.error(f"Error in fetching marketing data: {str(error)}")
+        logging.error("Error in fetching marketing data: %s", error)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=str(error))
+
+
+@app.post("/authz/v1/check", response_model=AuthzCheckResponse)
+async def authz_check(request: Request, authz_request: AuthzCheck, db: AsyncSession = Depends(get_read_db)):
+    """This API will authorize all the provided (asset, action) pairs for the bearer token in one call."""
+    logging.info("Checking %s permissions for the session user.", len(authz_request.checks))
+    user_access = await get_user_access(request.headers.get("authorization"), db)
+    if user_access is None:
+        logging.error("Session user could not be authenticated.")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token!")
+    return fast_response(AuthzCheckResponse, user_id=user_access["user_id"], results=[
+        AuthzCheckResult.model_construct(asset=check.asset, action=check.action,
+                                         allowed=check_access(user_access, check.asset, check.action))
+        for check in authz_request.checks
+    ])
+
+
+@app.post("/users/v1/bulk_register")
+async def bulk_register(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """This API will register users streamed as NDJSON or CSV and stream back one result per row."""
+    logging.info("Checking if session user has permission to import users.")
+    is_permitted = await get_permission(request.headers.get("authorization"), 'admin', db)
+    if not is_permitted:
+        logging.error("Session user is not permitted to import users.")
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied!")
+    logging.info("Bulk user import starts.")
+    upload = await spool_upload(request.stream())
+    return StreamingResponse(import_users(iter_spool(upload), request.headers.get("content-type", "")),
+                             media_type="application/x-ndjson")
@@ -0,0 +1,256 @@
+# This is the metrics module.
+# A tiny registry rendered in the Prometheus text exposition format. Request handling only
+# pays for a few dict lookups and additions, everything derived is computed at scrape time.
+
+import bisect
+import contextvars
+import time
+
+from sqlalchemy import event
+
+from constants import METRICS_LATENCY_BUCKETS, METRICS_SQL_COUNT_BUCKETS
+
+# [statement count, seconds] of the request being served, set by the metrics middleware.
+request_sql = contextvars.ContextVar("request_sql", default=None)
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}  # label values -> float
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        values = self._values.get(label_values)
+        if values is None:
+            values = self._values[label_values] = [0] * (len(self.buckets) + 2)
+        # Counts are per bucket here and made cumulative when rendered.
+        bucket = bisect.bisect_left(self.buckets, value)
+        if bucket < len(self.buckets):
+            values[bucket] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, values in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _labels(self.labels + ("le",), label_values + (repr(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {values[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {values[-1]}")
+        return lines
+
+
+def render_gauges(name: str, documentation: str, samples: dict, labels: tuple = ()) -> list:
+    """Render gauges read at scrape time, samples maps label values to the value."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    for label_values, value in samples.items():
+        lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # callables returning rendered lines at scrape time
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "ums_request_duration_seconds", "Request latency by route.", METRICS_LATENCY_BUCKETS, ("method", "route", "status"))
+request_sql_statements = registry.histogram(
+    "ums_request_sql_statements", "SQL statements executed per request.", METRICS_SQL_COUNT_BUCKETS, ("route",))
+request_sql_seconds = registry.histogram(
+    "ums_request_sql_duration_seconds", "Time spent in SQL per request.", METRICS_LATENCY_BUCKETS, ("route",))
+sql_statements = registry.counter("ums_sql_statements_total", "SQL statements executed.")
+sql_seconds = registry.counter("ums_sql_duration_seconds_total", "Time spent executing SQL statements.")
+authorization_seconds = registry.histogram(
+    "ums_authorization_duration_seconds", "Time to resolve a permission check.", METRICS_LATENCY_BUCKETS, ("role",))
+
+
+def instrument_engine(engine):
+    """Count and time every statement of the (sync side of the) engine."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._metrics_started
+        sql_statements.inc()
+        sql_seconds.inc(amount=seconds)
+        current = request_sql.get()
+        if current is not None:
+            current[0] += 1
+            current[1] += seconds
+
+
+def collect_password_pool(password_pool):
+    def collect():
+        stats = password_pool.stats()
+        lines = [
+            "# HELP ums_password_hash_seconds Time spent hashing and verifying passwords in the worker pool.",
+            "# TYPE ums_password_hash_seconds summary",
+            f"ums_password_hash_seconds_sum {stats['hash_seconds_total']}",
+            f"ums_password_hash_seconds_count {stats['completed']}",
+            "# HELP ums_password_queue_wait_seconds Time password operations waited for a worker.",
+            "# TYPE ums_password_queue_wait_seconds summary",
+            f"ums_password_queue_wait_seconds_sum {stats['queue_wait_seconds_total']}",
+            f"ums_password_queue_wait_seconds_count {stats['completed']}",
+            "# HELP ums_password_rejected_total Password operations rejected because the pool was full.",
+            "# TYPE ums_password_rejected_total counter",
+            f"ums_password_rejected_total {stats['rejected']}",
+        ]
+        return lines + render_gauges("ums_password_pending", "Password operations pending in the worker pool.",
+                                     {(): stats["pending"]})
+    return collect
+
+
+def collect_caches(caches: dict):
+    """Hit and miss counters plus the hit ratio of every {name: cache} with stats()."""
+    def collect():
+        stats = {(name,): cache.stats() for name, cache in caches.items()}
+        ratios = {key: round(value["hits"] / (value["hits"] + value["misses"]), 4)
+                  if value["hits"] + value["misses"] else 0.0 for key, value in stats.items()}
+        return (
+            ["# HELP ums_cache_hits_total Cache hits.", "# TYPE ums_cache_hits_total counter"] +
+            [f'ums_cache_hits_total{{cache="{name}"}} {value["hits"]}' for (name,), value in stats.items()] +
+            ["# HELP ums_cache_misses_total Cache misses.", "# TYPE ums_cache_misses_total counter"] +
+            [f'ums_cache_misses_total{{cache="{name}"}} {value["misses"]}' for (name,), value in stats.items()] +
+            render_gauges("ums_cache_hit_ratio", "Share of cache lookups that were hits.", ratios, ("cache",)) +
+            render_gauges("ums_cache_size", "Entries held by the cache.",
+                          {key: value["size"] for key, value in stats.items()}, ("cache",))
+        )
+    return collect
+
+
+def collect_pools(engines: dict):
+    """Connection pool gauges of every {name: engine}, read from the pools at scrape time."""
+    def collect():
+        pools = {(name,): engine.pool for name, engine in engines.items() if hasattr(engine.pool, "checkedout")}
+        timed = {key: pool.stats() for key, pool in pools.items() if hasattr(pool, "stats")}
+        labels = ("engine",)
+        return (
+            render_gauges("ums_db_pool_size", "Configured size of the connection pool.",
+                          {key: pool.size() for key, pool in pools.items()}, labels) +
+            render_gauges("ums_db_pool_checked_out", "Connections checked out of the pool.",
+                          {key: pool.checkedout() for key, pool in pools.items()}, labels) +
+            # overflow() counts down from -pool_size while the pool is not full yet.
+            render_gauges("ums_db_pool_overflow", "Connections open beyond the pool size.",
+                          {key: max(pool.overflow(), 0) for key, pool in pools.items()}, labels) +
+            render_gauges("ums_db_pool_waiting", "Checkouts waiting for a connection.",
+                          {key: stats["waiting"] for key, stats in timed.items()}, labels) +
+            ["# HELP ums_db_pool_wait_seconds Time spent waiting for a pooled connection.",
+             "# TYPE ums_db_pool_wait_seconds summary"] +
+            [line for (name,), stats in timed.items() for line in (
+                f'ums_db_pool_wait_seconds_sum{{engine="{name}"}} {stats["wait_seconds_total"]}',
+                f'ums_db_pool_wait_seconds_count{{engine="{name}"}} {stats["checkouts"]}')] +
+            render_gauges("ums_db_pool_max_wait_seconds", "Longest wait for a pooled connection.",
+                          {key: stats["max_wait_seconds"] for key, stats in timed.items()}, labels)
+        )
+    return collect
+
+
+def collect_admission(cost_classes: dict, login_limiter):
+    """Admission gauges and shed counters of every {name: cost class}, plus rate limited logins."""
+    def collect():
+        stats = {(name,): cost_class.stats() for name, cost_class in cost_classes.items()}
+        labels = ("class",)
+        return (
+            render_gauges("ums_admission_limit", "Requests of the class admitted at once.",
+                          {key: value["limit"] for key, value in stats.items()}, labels) +
+            render_gauges("ums_admission_active", "Requests of the class being served.",
+                          {key: value["active"] for key, value in stats.items()}, labels) +
+            render_gauges("ums_admission_waiting", "Requests of the class waiting for a slot.",
+                          {key: value["waiting"] for key, value in stats.items()}, labels) +
+            ["# HELP ums_admission_shed_total Requests shed with 503 because the class was saturated.",
+             "# TYPE ums_admission_shed_total counter"] +
+            [f'ums_admission_shed_total{{class="{name}"}} {value["shed"]}' for (name,), value in stats.items()] +
+            ["# HELP ums_login_rate_limited_total Login attempts rejected with 429 by the rate limits.",
+             "# TYPE ums_login_rate_limited_total counter",
+             f"ums_login_rate_limited_total {login_limiter.limited}"]
+        )
+    return collect
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every request and the SQL it runs, labelled by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+        sql = [0, 0.0]
+        token = request_sql.set(sql)
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            request_sql.reset(token)
+            # The router stores the matched route in the scope, unmatched paths share one label.
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            request_seconds.observe(seconds, scope["method"], route, str(status_code))
+            request_sql_statements.observe(sql[0], route)
+            request_sql_seconds.observe(sql[1], route)
@@ -0,0 +1,74 @@
+# This is the password hash policy module.
+# The schemes and their cost come from the constants, so the CPU/security trade-off can be tuned
+# per deployment. Stored hashes made under another policy are rehashed on the next login.
+#
+# Calibration (from the ums_v2 directory):
+#   python password_policy.py calibrate                          # bcrypt, PASSWORD_HASH_TARGET_SECONDS per hash
+#   python password_policy.py calibrate --scheme pbkdf2_sha256 --target-ms 100
+
+import argparse
+import math
+import time
+
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+from constants import PASSWORD_HASH_TARGET_SECONDS, PASSWORD_ROUNDS, PASSWORD_SCHEMES
+
+CALIBRATION_PASSWORD = "calibration-password"
+
+
+def build_context(schemes: list, rounds: dict) -> CryptContext:
+    """Hash with the first scheme, keep verifying the others and flag every other scheme or cost for update."""
+    settings = {}
+    for scheme, scheme_rounds in rounds.items():
+        # Pinning min and max as well makes needs_update() true for hashes above and below the cost.
+        settings.update({f"{scheme}__default_rounds": scheme_rounds, f"{scheme}__min_rounds": scheme_rounds,
+                         f"{scheme}__max_rounds": scheme_rounds})
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+
+pwd_context = build_context(PASSWORD_SCHEMES, PASSWORD_ROUNDS)
+
+
+def time_hash(scheme: str, rounds: int, samples: int = 3) -> float:
+    """Median seconds of one hash with the scheme at the given rounds."""
+    handler = get_crypt_handler(scheme).using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash(CALIBRATION_PASSWORD)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def calibrate(scheme: str, target_seconds: float) -> tuple:
+    """Return (rounds, seconds per hash) of the cost closest to the target on this machine."""
+    handler = get_crypt_handler(scheme)
+    rounds = PASSWORD_ROUNDS.get(scheme, handler.default_rounds)
+    elapsed = time_hash(scheme, rounds)
+    if handler.rounds_cost == "log2":
+        # Each extra round doubles the work.
+        estimate = rounds + round(math.log2(target_seconds / elapsed))
+    else:
+        estimate = round(rounds * target_seconds / elapsed)
+    estimate = min(max(estimate, handler.min_rounds), handler.max_rounds)
+    return estimate, time_hash(scheme, estimate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password hash policy tools.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = commands.add_parser("calibrate", help="Find the cost hitting a target hash latency.")
+    calibrate_parser.add_argument("--scheme", default=PASSWORD_SCHEMES[0])
+    calibrate_parser.add_argument("--target-ms", type=float, default=PASSWORD_HASH_TARGET_SECONDS * 1000)
+    args = parser.parse_args()
+
+    rounds, seconds = calibrate(args.scheme, args.target_ms / 1000)
+    print(f"{args.scheme}: {rounds} rounds take {seconds * 1000:.1f} ms per hash on this machine, "
+          f"about {1 / seconds:.1f} logins per second per password pool worker.")
+    print(f"UMS_PASSWORD_ROUNDS={args.scheme}={rounds}")
+
+
+if __name__ == "__main__":
+    main()
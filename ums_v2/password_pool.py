@@ -0,0 +1,121 @@
+# This is the password hashing worker pool module.
+# bcrypt is CPU bound, so hashing and verification run in a dedicated process pool
+# instead of the request thread pool or the event loop.
+
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from constants import PASSWORD_POOL_BULK_CHUNK_SIZE, PASSWORD_POOL_MAX_PENDING, PASSWORD_POOL_WORKERS
+from password_policy import pwd_context
+
+
+class PasswordPoolFull(Exception):
+    """Raised when too many password operations are already waiting for a worker."""
+
+
+def _timed_hash(password: str):
+    start = time.perf_counter()
+    hashed_password = pwd_context.hash(password)
+    return hashed_password, time.perf_counter() - start
+
+
+def _timed_hash_many(passwords: list):
+    start = time.perf_counter()
+    hashed_passwords = [pwd_context.hash(password) for password in passwords]
+    return hashed_passwords, time.perf_counter() - start
+
+
+def _timed_verify(plain_password: str, hashed_password: str):
+    start = time.perf_counter()
+    is_valid = pwd_context.verify(plain_password, hashed_password)
+    return is_valid, time.perf_counter() - start
+
+
+class PasswordPool:
+    """Bounded process pool for password hashing with queue wait and hash time metrics."""
+
+    def __init__(self, workers: int = PASSWORD_POOL_WORKERS, max_pending: int = PASSWORD_POOL_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hash_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self._executor = None
+        self._bulk_slots = None  # Semaphore of the bulk chunks in flight, created on the serving loop.
+
+    def start(self):
+        if self._executor is None:
+            # Spawned workers only import this module, not the app and its db engine.
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_timed_hash, password)
+
+    async def hash_many(self, passwords: list) -> list:
+        """Hash a batch of passwords in chunks of PASSWORD_POOL_BULK_CHUNK_SIZE.
+        At most workers - 1 chunks are in flight, so a worker is always left to interactive hashing and
+        verification, or with a single worker they wait for one short chunk instead of the whole batch.
+        A batch is not latency sensitive, so its chunks wait for a slot instead of failing on a full pool.
+        """
+        if not passwords:
+            return []
+        if self._bulk_slots is None:
+            self._bulk_slots = asyncio.Semaphore(max(self.workers - 1, 1))
+        chunks = [passwords[index:index + PASSWORD_POOL_BULK_CHUNK_SIZE]
+                  for index in range(0, len(passwords), PASSWORD_POOL_BULK_CHUNK_SIZE)]
+        results = await asyncio.gather(*(self._run_bulk(chunk) for chunk in chunks))
+        return [hashed_password for chunk in results for hashed_password in chunk]
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit(_timed_verify, plain_password, hashed_password)
+
+    async def _submit(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordPoolFull(f"{self.pending} password operations already pending.")
+        return await self._run(func, *args)
+
+    async def _run_bulk(self, passwords: list) -> list:
+        async with self._bulk_slots:
+            return await self._run(_timed_hash_many, passwords)
+
+    async def _run(self, func, *args):
+        self.start()
+        self.pending += 1
+        submitted_at = time.perf_counter()
+        try:
+            result, work_seconds = await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+        queue_wait = max(time.perf_counter() - submitted_at - work_seconds, 0.0)
+        self.completed += 1
+        self.hash_seconds += work_seconds
+        self.queue_wait_seconds += queue_wait
+        self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, queue_wait)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "hash_seconds_total": self.hash_seconds,
+            "queue_wait_seconds_total": self.queue_wait_seconds,
+            "max_queue_wait_seconds": self.max_queue_wait_seconds,
+        }
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,341 @@
+# This is the compiled role based access control index module.
+# It loads roles, permissions and their relations once and answers
+# permission checks from memory, refreshing incrementally in the background.
+# The refresh picks up rows by their updated_at, which create_tables.sql keeps current with BEFORE UPDATE
+# triggers, so rows changed outside the app are seen too. Deleted rows are only seen by the full reload.
+
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import DateTime, func, select, true, type_coerce
+
+from app_logger import logging
+from auth_cache import auth_cache
+from constants import RBAC_FULL_RELOAD_SECONDS, RBAC_REFRESH_OVERLAP_SECONDS, RBAC_REFRESH_SECONDS
+from container import SessionLocal
+from models import Assets, Permissions, RolePermissions, Roles, UserRoles, Users
+
+READ = 1
+CREATE = 2
+UPDATE = 4
+DELETE = 8
+ALL_ACTIONS = READ | CREATE | UPDATE | DELETE
+
+ACTIONS = {"read": READ, "create": CREATE, "update": UPDATE, "delete": DELETE}
+
+# Callbacks run when a refresh sees changed asset rows, e.g. to invalidate cached asset responses.
+asset_listeners = []
+
+# Permissions without an asset (like the superuser 'all' permission) apply to every asset.
+ANY_ASSET = 0
+ANY_ASSET_NAME = "*"
+
+
+def to_version(updated_at: datetime) -> int:
+    """Authorization versions are role change times in microseconds, comparable across workers.
+    Every version is taken from the database clock, naive like the updated_at columns, and read as UTC
+    so the app host's timezone plays no part.
+    """
+    return int(updated_at.replace(tzinfo=timezone.utc).timestamp() * 1000000)
+
+
+def db_now(db) -> datetime:
+    """The database clock, in the naive form the updated_at columns store it."""
+    if db.get_bind().dialect.name == "postgresql":
+        # LOCALTIMESTAMP is CURRENT_TIMESTAMP as a timestamp without time zone column stores it.
+        return db.scalar(select(func.localtimestamp()))
+    return db.scalar(select(type_coerce(func.current_timestamp(), DateTime)))
+
+
+def has_action(asset_masks: dict, asset: str, action: str) -> bool:
+    """Return True if the {asset_name: bitmask} map allows the action on the asset."""
+    action_bit = ACTIONS.get(action, 0)
+    mask = asset_masks.get(asset, 0) | asset_masks.get(ANY_ASSET_NAME, 0)
+    return bool(action_bit) and mask & action_bit == action_bit
+
+
+def permission_mask(permission) -> int:
+    """Compile the CRUD flags of a permission row into an action bitmask."""
+    if permission.asset_id is None and not any(
+            (permission.is_read, permission.is_create, permission.is_update, permission.is_delete)):
+        return ALL_ACTIONS
+    mask = 0
+    if permission.is_read:
+        mask |= READ
+    if permission.is_create:
+        mask |= CREATE
+    if permission.is_update:
+        mask |= UPDATE
+    if permission.is_delete:
+        mask |= DELETE
+    return mask
+
+
+class RbacIndex:
+    """In-memory index of (role, asset) -> action bitmask and user -> roles."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._asset_ids = {}  # asset_name -> asset_id
+        self._asset_names = {ANY_ASSET: ANY_ASSET_NAME}  # asset_id -> asset_name
+        self._role_names = {}  # role_id -> role_name
+        self._permissions = {}  # permission_id -> (asset_id, mask)
+        self._role_permissions = {}  # role_id -> set of permission_id
+        self._role_masks = {}  # role_id -> {asset_id: mask}
+        self._user_ids = {}  # username -> user_id
+        self._user_roles = {}  # user_id -> frozenset of role_id
+        self._user_versions = {}  # user_id -> authorization version, bumped whenever the user's roles change
+        self._unindexed_grants = {}  # user_id -> roles granted by this process to users not indexed yet
+        self._watermarks = {}  # table name -> latest updated_at seen
+        self.revision = 0  # Bumped whenever the index content changes.
+        self.as_of = 0  # Version of the database time before which every committed change is in the index.
+        self.ready = False
+
+    def load(self, db):
+        """Build the whole index from db, replacing the current one."""
+        logging.info("Loading RBAC index.")
+        # Taken before reading, so access resolved from the replaced index is older than any bump below.
+        loaded_at = to_version(db_now(db))
+        fresh = RbacIndex()
+        fresh._apply(db, since=None)
+        fresh.as_of = loaded_at
+        with self._lock:
+            # A removed role has no row left to version it, so a user who lost any role is bumped to the
+            # reload time. Versions never go back, tokens outdated once stay outdated.
+            revoked = {user_id for user_id in self._user_roles.keys() | self._unindexed_grants.keys()
+                       if not self._user_roles.get(user_id, frozenset()) | self._unindexed_grants.get(user_id, set())
+                       <= fresh._user_roles.get(user_id, frozenset())}
+            # Neither has a removed role_permissions row, so the holders of a role whose grants changed are too.
+            if self.ready:
+                changed_roles = {role_id for role_id in self._role_masks.keys() | fresh._role_masks.keys()
+                                 if self._role_masks.get(role_id) != fresh._role_masks.get(role_id)}
+                revoked |= self._holders(changed_roles) | fresh._holders(changed_roles)
+            for user_id, version in self._user_versions.items():
+                fresh._user_versions[user_id] = max(fresh._user_versions.get(user_id, 0), version)
+            for user_id in revoked:
+                fresh._user_versions[user_id] = max(fresh._user_versions.get(user_id, 0) + 1, loaded_at)
+            revoked_usernames = self._usernames(revoked)
+            revision = self.revision
+            self.__dict__.update({key: value for key, value in fresh.__dict__.items() if key != "_lock"})
+            self.revision = revision + 1
+            self.ready = True
+        for username in revoked_usernames:
+            auth_cache.invalidate_user(username)
+        if revoked:
+            logging.info("Roles or role permissions of %s users were removed, their tokens are outdated.",
+                         len(revoked))
+        logging.info("RBAC index loaded with %s roles and %s users.", len(self._role_names), len(self._user_roles))
+
+    def refresh(self, db):
+        """Apply only rows changed since the last load or refresh."""
+        if not self.ready:
+            return self.load(db)
+        started = to_version(db_now(db))
+        for username in self._apply(db, since=self._watermarks):
+            auth_cache.invalidate_user(username)
+        # Commits are only relied on up to the overlap window after their updated_at.
+        self.as_of = max(self.as_of, started - RBAC_REFRESH_OVERLAP_SECONDS * 1000000)
+
+    def can(self, user, asset, action) -> bool:
+        """Return True if the user (id or username) may perform the action on the asset (id or name)."""
+        user_id = self._user_ids.get(user) if isinstance(user, str) else user
+        asset_id = self._asset_ids.get(asset) if isinstance(asset, str) else asset
+        action = ACTIONS.get(action, 0) if isinstance(action, str) else action
+        if user_id is None or not action:
+            return False
+        for role_id in self._user_roles.get(user_id, ()):
+            masks = self._role_masks.get(role_id)
+            if masks and (masks.get(asset_id, 0) | masks.get(ANY_ASSET, 0)) & action == action:
+                return True
+        return False
+
+    def user_roles(self, username: str):
+        """Return (user_id, role_ids, role_names) for a user with roles, or None if not indexed."""
+        user_id = self._user_ids.get(username)
+        if user_id is None:
+            return None
+        role_ids = self._user_roles.get(user_id, frozenset())
+        return user_id, role_ids, self.role_names(role_ids)
+
+    def role_names(self, role_ids) -> frozenset:
+        return frozenset(self._role_names.get(role_id) for role_id in role_ids)
+
+    def user_version(self, user_id: int):
+        """Return the user's authorization version, or None while the index is not loaded."""
+        if not self.ready:
+            return None
+        return self._user_versions.get(user_id, 0)
+
+    def user_role_ids(self, user_id: int) -> frozenset:
+        """Role ids the user holds now, including the ones this process granted before they were indexed."""
+        return self._user_roles.get(user_id, frozenset()) | self._unindexed_grants.get(user_id, frozenset())
+
+    def asset_masks(self, role_ids) -> dict:
+        """Return the merged {asset_name: action bitmask} granted by the roles."""
+        merged = {}
+        for role_id in role_ids:
+            for asset_id, mask in self._role_masks.get(role_id, {}).items():
+                asset_name = self._asset_names.get(asset_id)
+                if asset_name is not None:
+                    merged[asset_name] = merged.get(asset_name, 0) | mask
+        return merged
+
+    def grant(self, user_id: int, username: str, role_id: int, granted_at: datetime):
+        """Record a role assignment made by this process without waiting for the next refresh.
+        granted_at is the updated_at of the inserted user_roles row.
+        Users not indexed yet are left to the db fallback, a partial entry would hide their other roles.
+        """
+        with self._lock:
+            if user_id in self._user_roles:
+                self._user_roles[user_id] = self._user_roles[user_id] | {role_id}
+            else:
+                # Only remembered to notice at the next load if the role was removed again.
+                self._unindexed_grants.setdefault(user_id, set()).add(role_id)
+            self._user_versions[user_id] = max(self._user_versions.get(user_id, 0) + 1, to_version(granted_at))
+            self.revision += 1
+
+    def export(self) -> dict:
+        """Consistent copy of the index content, to write the shared snapshot from."""
+        with self._lock:
+            return {
+                "revision": self.revision,
+                "as_of": self.as_of,
+                "user_ids": dict(self._user_ids),
+                "user_roles": dict(self._user_roles),
+                "user_versions": dict(self._user_versions),
+                "role_names": dict(self._role_names),
+                "role_masks": {role_id: dict(masks) for role_id, masks in self._role_masks.items()},
+                "asset_names": dict(self._asset_names),
+                "assets_version": to_version(self._watermarks["assets"]) if "assets" in self._watermarks else 0,
+            }
+
+    def _since(self, since, table, column):
+        if not since or table not in since:
+            return true()
+        return column > since[table] - timedelta(seconds=RBAC_REFRESH_OVERLAP_SECONDS)
+
+    def _holders(self, role_ids) -> set:
+        """Users holding any of the roles, including the ones this process granted them before they were indexed."""
+        if not role_ids:
+            return set()
+        return {user_id for user_id in self._user_roles.keys() | self._unindexed_grants.keys()
+                if self.user_role_ids(user_id) & role_ids}
+
+    def _usernames(self, user_ids) -> list:
+        return [username for username, user_id in self._user_ids.items() if user_id in user_ids]
+
+    def _apply(self, db, since) -> list:
+        """Apply the rows changed since the watermarks (all rows if since is None).
+        Return the usernames whose access got outdated because permissions of a role they hold changed.
+        """
+        assets = db.query(Assets.id, Assets.asset_name, Assets.updated_at).\
+            filter(self._since(since, "assets", Assets.updated_at)).all()
+        roles = db.query(Roles.role_id, Roles.role_name, Roles.updated_at).\
+            filter(self._since(since, "roles", Roles.updated_at)).all()
+        permissions = db.query(Permissions).\
+            filter(self._since(since, "permissions", Permissions.updated_at)).all()
+        role_permissions = db.query(RolePermissions.role_id, RolePermissions.permission_id,
+                                    RolePermissions.updated_at).\
+            filter(self._since(since, "role_permissions", RolePermissions.updated_at)).all()
+        assets_changed = since is not None and any(
+            row.updated_at and ("assets" not in since or row.updated_at > since["assets"]) for row in assets)
+        user_roles = db.query(UserRoles.user_id, UserRoles.role_id, Users.username, UserRoles.updated_at).\
+            join(Users, Users.user_id == UserRoles.user_id).\
+            filter(self._since(since, "user_roles", UserRoles.updated_at)).all()
+
+        with self._lock:
+            for asset in assets:
+                self._asset_ids[asset.asset_name] = asset.id
+                self._asset_names[asset.id] = asset.asset_name
+            for role in roles:
+                self._role_names[role.role_id] = role.role_name
+            changed_roles = {row.role_id for row in role_permissions}
+            previous_masks = {}
+            for permission in permissions:
+                self._permissions[permission.permission_id] = (
+                    permission.asset_id or ANY_ASSET, permission_mask(permission))
+                changed_roles.update(role_id for role_id, permission_ids in self._role_permissions.items()
+                                     if permission.permission_id in permission_ids)
+            for row in role_permissions:
+                self._role_permissions.setdefault(row.role_id, set()).add(row.permission_id)
+            for role_id in changed_roles:
+                previous_masks[role_id] = self._role_masks.get(role_id)
+                masks = {}
+                for permission_id in self._role_permissions.get(role_id, ()):
+                    asset_id, mask = self._permissions.get(permission_id, (ANY_ASSET, 0))
+                    masks[asset_id] = masks.get(asset_id, 0) | mask
+                self._role_masks[role_id] = masks
+            outdated = set()
+            if since is not None:
+                # Tokens embed the asset masks, so the holders of a role whose masks changed get a version past
+                # the change. Rows re-read through the overlap window leave the masks as they were.
+                outdated = self._holders({role_id for role_id in changed_roles
+                                          if self._role_masks[role_id] != previous_masks[role_id]})
+                changed_at = max((to_version(row.updated_at) for row in [*permissions, *role_permissions]
+                                  if row.updated_at), default=0)
+                for user_id in outdated:
+                    self._user_versions[user_id] = max(self._user_versions.get(user_id, 0) + 1, changed_at)
+                if outdated:
+                    self.revision += 1
+            for row in user_roles:
+                self._user_ids[row.username] = row.user_id
+                self._user_roles[row.user_id] = self._user_roles.get(row.user_id, frozenset()) | {row.role_id}
+                if row.updated_at:
+                    self._user_versions[row.user_id] = max(self._user_versions.get(row.user_id, 0),
+                                                           to_version(row.updated_at))
+
+            for table, rows in (("assets", assets), ("roles", roles), ("permissions", permissions),
+                                ("role_permissions", role_permissions), ("user_roles", user_roles)):
+                latest = max((row.updated_at for row in rows if row.updated_at), default=None)
+                if latest and (table not in self._watermarks or latest > self._watermarks[table]):
+                    # Rows re-read through the overlap window do not move the watermark, new rows do.
+                    self._watermarks[table] = latest
+                    self.revision += 1
+
+        if assets_changed:
+            for listener in asset_listeners:
+                listener()
+        if outdated:
+            logging.info("Role permissions of %s users changed, their tokens are outdated.", len(outdated))
+        return self._usernames(outdated)
+
+
+rbac_index = RbacIndex()
+
+
+def _refresh_loop(stop: threading.Event, on_refresh):
+    elapsed = 0
+    while not stop.wait(RBAC_REFRESH_SECONDS):
+        elapsed += RBAC_REFRESH_SECONDS
+        db = SessionLocal()
+        try:
+            if elapsed >= RBAC_FULL_RELOAD_SECONDS:
+                # Deleted rows have no watermark, so they are picked up by a periodic full reload.
+                rbac_index.load(db)
+                elapsed = 0
+            else:
+                rbac_index.refresh(db)
+            if on_refresh is not None:
+                on_refresh()
+        except Exception as error:
+            logging.error("Error in refreshing RBAC index: %s", error)
+        finally:
+            db.close()
+
+
+def start_rbac_refresher(on_refresh=None, stop: threading.Event = None) -> threading.Event:
+    """Load the index and keep it fresh from a daemon thread. Set the returned event to stop it.
+    on_refresh is called after the load and after every refresh.
+    """
+    db = SessionLocal()
+    try:
+        rbac_index.load(db)
+        if on_refresh is not None:
+            on_refresh()
+    except Exception as error:
+        logging.error("Error in loading RBAC index, falling back to db lookups: %s", error)
+    finally:
+        db.close()
+    stop = stop or threading.Event()
+    threading.Thread(target=_refresh_loop, args=(stop, on_refresh), name="rbac-refresher", daemon=True).start()
+    return stop
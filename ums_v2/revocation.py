@@ -0,0 +1,120 @@
+# This is the access token revocation module.
+# Revoked token ids (jti) are held in memory, so checking a token is a single dict lookup. They are grouped
+# in buckets by token expiry and a whole bucket is forgotten once its tokens would have expired anyway,
+# which bounds memory by the revocations of the last token lifetime.
+# Revocations are stored in the revoked_tokens table, loaded at startup and polled by every worker.
+
+import calendar
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from app_logger import logging
+from constants import REVOCATION_BUCKET_SECONDS, REVOCATION_PURGE_SECONDS, REVOCATION_SYNC_OVERLAP_SECONDS, \
+    REVOCATION_SYNC_SECONDS
+from container import SessionLocal, upsert_insert
+from models import RevokedTokens
+
+
+class RevocationSet:
+    """Revoked token ids, expiring in buckets of bucket_seconds."""
+
+    def __init__(self, bucket_seconds: int = REVOCATION_BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._revoked = {}  # jti -> expiry bucket
+        self._buckets = {}  # expiry bucket -> set of jti
+        self._lock = threading.Lock()
+        self.synced_at = None  # Start of the last sync, in db time (naive UTC).
+
+    def __contains__(self, jti) -> bool:
+        return jti in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def add(self, jti: str, expires_at: float):
+        """Revoke the token id until the epoch timestamp it expires at."""
+        # Rounded up, so a bucket is only dropped after its last token expired.
+        bucket = int(expires_at // self.bucket_seconds) + 1
+        with self._lock:
+            if jti not in self._revoked:
+                self._revoked[jti] = bucket
+                self._buckets.setdefault(bucket, set()).add(jti)
+
+    def expire(self, now: float = None) -> int:
+        """Forget the buckets whose tokens have all expired, return how many ids were dropped."""
+        current = int((now or time.time()) // self.bucket_seconds)
+        dropped = 0
+        with self._lock:
+            for bucket in [bucket for bucket in self._buckets if bucket <= current]:
+                for jti in self._buckets.pop(bucket):
+                    del self._revoked[jti]
+                    dropped += 1
+        return dropped
+
+    def sync(self, db) -> int:
+        """Add the unexpired revocations stored since the last sync, or all of them the first time."""
+        started = datetime.utcnow()
+        query = select(RevokedTokens.jti, RevokedTokens.expires_at).where(RevokedTokens.expires_at > started)
+        if self.synced_at is not None:
+            query = query.where(
+                RevokedTokens.revoked_at > self.synced_at - timedelta(seconds=REVOCATION_SYNC_OVERLAP_SECONDS))
+        rows = db.execute(query).all()
+        for jti, expires_at in rows:
+            self.add(jti, calendar.timegm(expires_at.timetuple()))
+        self.synced_at = started
+        self.expire()
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {"size": len(self._revoked), "buckets": len(self._buckets)}
+
+
+revocations = RevocationSet()
+
+
+async def revoke_access_token(jti: str, expires_at: float, db):
+    """Store the revocation and apply it to this worker at once, the others pick it up when they sync."""
+    await db.execute(upsert_insert(RevokedTokens).values(
+        jti=jti, expires_at=datetime.utcfromtimestamp(expires_at), revoked_at=datetime.utcnow()).
+        on_conflict_do_nothing())
+    await db.commit()
+    revocations.add(jti, expires_at)
+
+
+def purge_revocations(db) -> int:
+    """Delete the revocations of expired tokens and return how many were deleted."""
+    deleted = db.execute(delete(RevokedTokens).where(RevokedTokens.expires_at <= datetime.utcnow())).rowcount
+    db.commit()
+    return deleted
+
+
+def _sync_loop(stop: threading.Event):
+    purged_at = time.monotonic()
+    while not stop.wait(REVOCATION_SYNC_SECONDS):
+        db = SessionLocal()
+        try:
+            revocations.sync(db)
+            if time.monotonic() - purged_at >= REVOCATION_PURGE_SECONDS:
+                purged_at = time.monotonic()
+                logging.info("Purged %s revocations of expired tokens.", purge_revocations(db))
+        except Exception as error:
+            logging.error("Error in syncing token revocations: %s", error)
+        finally:
+            db.close()
+
+
+def start_revocation_sync() -> threading.Event:
+    """Load the revocations and keep polling for new ones from a daemon thread. Set the returned event to stop it."""
+    db = SessionLocal()
+    try:
+        logging.info("Loaded %s token revocations.", revocations.sync(db))
+    except Exception as error:
+        logging.error("Error in loading token revocations: %s", error)
+    finally:
+        db.close()
+    stop = threading.Event()
+    threading.Thread(target=_sync_loop, args=(stop,), name="revocation-sync", daemon=True).start()
+    return stop
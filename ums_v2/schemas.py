@@ -1,10 +1,13 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field, model_validator
 
 
 class User(BaseModel):
-    username: str
+    username: str = Field(max_length=100)  # The lengths of the users columns.
     password: str
-    email: str
+    email: str = Field(max_length=100)
 
 
 class UserLogin(BaseModel):
@@ -12,7 +15,101 @@ class UserLogin(BaseModel):
     password: str
 
 
+class RefreshToken(BaseModel):
+    """Schema for API to exchange a refresh token for new tokens."""
+    refresh_token: str
+
+
+class RevokeToken(BaseModel):
+    """Schema for API to revoke a refresh token, or every session of its user."""
+    refresh_token: str
+    all_sessions: bool = False
+
+
+class Logout(BaseModel):
+    """Schema for API to log out, the refresh token session is revoked as well if given."""
+    refresh_token: Optional[str] = None
+
+
 class AssignUserRole(BaseModel):
     """Schema for API to assign role to a user."""
     user_id: int
     role_id: int
+
+
+class AuthzCheckItem(BaseModel):
+    """One (asset, action) pair to authorize."""
+    asset: str
+    action: Literal["read", "create", "update", "delete"]
+
+
+class AuthzCheck(BaseModel):
+    """Schema for API to authorize many (asset, action) pairs for one token."""
+    checks: List[AuthzCheckItem]
+
+
+class BulkAssignUserRoles(BaseModel):
+    """Schema for API to assign roles in bulk.
+    Either a list of (user_id, role_id) assignments, or one role_id for a list of user_ids, or both.
+    """
+    assignments: List[AssignUserRole] = []
+    role_id: Optional[int] = None
+    user_ids: List[int] = []
+
+    @model_validator(mode="after")
+    def check_role_of_user_ids(self):
+        if self.user_ids and self.role_id is None:
+            raise ValueError("role_id is required with user_ids.")
+        return self
+
+
+class MessageResponse(BaseModel):
+    message: str
+
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str
+    refresh_token: str
+
+
+class RevokeResponse(BaseModel):
+    revoked: int
+
+
+class RoleAssignmentResponse(BaseModel):
+    user_name: str
+    role: str
+    message: str
+
+
+class BulkAssignResult(BaseModel):
+    user_id: int
+    role_id: int
+    status: Literal["assigned", "already_assigned", "user_not_found", "role_not_found"]
+
+
+class BulkAssignResponse(BaseModel):
+    assigned: int
+    results: List[BulkAssignResult]
+
+
+class AssetResponse(BaseModel):
+    id: int
+    asset_name: str
+    is_secret: Optional[bool]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    created_by: Optional[str]
+    updated_by: Optional[str]
+
+
+class AuthzCheckResult(BaseModel):
+    asset: str
+    action: str
+    allowed: bool
+
+
+class AuthzCheckResponse(BaseModel):
+    user_id: int
+    results: List[AuthzCheckResult]
@@ -0,0 +1,106 @@
+# This is the refresh token session module.
+# Refresh tokens are random, so they are stored as a plain sha256 digest and looked up
+# by it, which keeps a refresh far cheaper than a password verification.
+# Every refresh rotates the token, and presenting a rotated token revokes the session.
+
+import hashlib
+import secrets
+import threading
+from datetime import datetime, timedelta
+from typing import Union
+
+from sqlalchemy import delete, or_, select, update
+
+from app_logger import logging
+from constants import REFRESH_TOKEN_EXPIRE_DAYS, SESSION_PURGE_SECONDS
+from container import SessionLocal
+from models import Sessions
+
+
+def hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+def _new_token() -> tuple:
+    """Return (refresh token, its hash, its expiry)."""
+    refresh_token = secrets.token_urlsafe(32)
+    return refresh_token, hash_refresh_token(refresh_token), \
+        datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+
+async def create_session(user_id: int, db) -> str:
+    """Open a session for the user and return its refresh token."""
+    refresh_token, token_hash, expires_at = _new_token()
+    db.add(Sessions(user_id=user_id, refresh_token_hash=token_hash, expires_at=expires_at))
+    await db.commit()
+    return refresh_token
+
+
+async def rotate_session(refresh_token: str, db) -> Union[tuple, None]:
+    """Swap a live refresh token for a new one and return (user_id, new refresh token).
+    Return None if the token is unknown, expired or revoked.
+    """
+    token_hash = hash_refresh_token(refresh_token)
+    new_token, new_hash, expires_at = _new_token()
+    now = datetime.utcnow()
+    user_id = await db.scalar(
+        update(Sessions).
+        where(Sessions.refresh_token_hash == token_hash).
+        where(Sessions.revoked_at.is_(None)).
+        where(Sessions.expires_at > now).
+        values(refresh_token_hash=new_hash, previous_token_hash=token_hash, expires_at=expires_at).
+        returning(Sessions.user_id))
+    if user_id is None:
+        reused = await db.scalar(
+            update(Sessions).
+            where(Sessions.previous_token_hash == token_hash).
+            where(Sessions.revoked_at.is_(None)).
+            values(revoked_at=now).
+            returning(Sessions.session_id))
+        if reused is not None:
+            logging.error("Rotated refresh token of session %s was presented again, revoking the session.", reused)
+    await db.commit()
+    return (user_id, new_token) if user_id is not None else None
+
+
+async def revoke_session(refresh_token: str, db, all_sessions: bool = False) -> int:
+    """Revoke the session of the refresh token, or every session of its user. Return the count revoked."""
+    token_hash = hash_refresh_token(refresh_token)
+    user_id = await db.scalar(select(Sessions.user_id).where(Sessions.refresh_token_hash == token_hash).
+                              where(Sessions.revoked_at.is_(None)))
+    if user_id is None:
+        return 0
+    statement = update(Sessions).where(Sessions.revoked_at.is_(None))
+    if all_sessions:
+        statement = statement.where(Sessions.user_id == user_id)
+    else:
+        statement = statement.where(Sessions.refresh_token_hash == token_hash)
+    revoked = (await db.execute(statement.values(revoked_at=datetime.utcnow()))).rowcount
+    await db.commit()
+    return revoked
+
+
+def purge_sessions(db) -> int:
+    """Delete expired and revoked sessions and return how many were deleted."""
+    deleted = db.execute(delete(Sessions).where(
+        or_(Sessions.expires_at <= datetime.utcnow(), Sessions.revoked_at.is_not(None)))).rowcount
+    db.commit()
+    return deleted
+
+
+def _purge_loop(stop: threading.Event):
+    while not stop.wait(SESSION_PURGE_SECONDS):
+        db = SessionLocal()
+        try:
+            logging.info("Purged %s expired or revoked sessions.", purge_sessions(db))
+        except Exception as error:
+            logging.error("Error in purging sessions: %s", error)
+        finally:
+            db.close()
+
+
+def start_session_purger() -> threading.Event:
+    """Purge sessions periodically from a daemon thread. Set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=_purge_loop, args=(stop,), name="session-purger", daemon=True).start()
+    return stop
@@ -1,16 +1,25 @@
+import time
+import uuid
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
+from sqlalchemy import select, update
 from typing import Union
 
-from constants import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
+from constants import ACCESS_TOKEN_EXPIRE_MINUTES, ADMIN_ROLE_ID, ALGORITHM, SECRET_KEY
 from app_logger import logging
-from models import Users, Roles, UserRoles
+from auth_cache import auth_cache
+from container import AsyncSessionLocal
+from metrics import authorization_seconds
+from models import Assets, Permissions, RolePermissions, Roles, UserRoles, Users
+from password_pool import PasswordPoolFull, password_pool
+from password_policy import pwd_context
+from revocation import revocations
+from authz_snapshot import authz_index
+from rbac import ANY_ASSET_NAME, has_action, permission_mask
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
@@ -24,6 +33,39 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def verify_password_async(plain_password, hashed_password):
+    logging.info("Verifying password in the password pool.")
+    return await password_pool.verify(plain_password, hashed_password)
+
+
+async def get_password_hash_async(password):
+    logging.info("Hashing password in the password pool.")
+    return await password_pool.hash(password)
+
+
+def password_needs_update(hashed_password) -> bool:
+    """True if the stored hash was made with another scheme or cost than the current policy."""
+    return pwd_context.needs_update(hashed_password)
+
+
+async def rehash_password(user_id: int, old_hash: str, plain_password: str):
+    """Store a hash of the password under the current policy, run in the background after login.
+    The stored hash is only replaced if it did not change in the meantime.
+    """
+    try:
+        new_hash = await password_pool.hash(plain_password)
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(Users).
+                             where(Users.user_id == user_id).where(Users.password == old_hash).
+                             values(password=new_hash))
+            await db.commit()
+        logging.info("Password hash of user %s updated to the current policy.", user_id)
+    except PasswordPoolFull:
+        logging.info("Password pool is busy, the rehash of user %s waits for the next login.", user_id)
+    except Exception as error:
+        logging.error("Error while rehashing the password of user %s: %s", user_id, error)
+
+
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
     logging.info("Creating access token.")
     to_encode = data.copy()
@@ -31,8 +73,8 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    logging.info("Adding expiring time of token.")
-    to_encode.update({"exp": expire})
+    logging.info("Adding expiring time and id of token.")
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     logging.info("Encoding the token.")
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -48,40 +90,149 @@ def decode_access_token(token: str):
         return None
 
 
-def get_permission(token: str, role: str, db) -> bool:
-    """This function will return True if the user is permitted."""
-    # TODO: We can use caching mechanism as following.
-    # Flow will be like,
-    # Check if provided token is available,
-    # if available then return True or False based on the comparison of provided role and cached role.
-    # if not available then fetch the data from db,
-    # store data in cache in this pattern {<token>: {"username": <username>, "role": <role_name>}}
-    # Keep Threshold time same as JWT Token expiry time. This way stale token will be removed automatically.
+async def load_user_access(username: str, db) -> Union[dict, None]:
+    """Resolve the user's id, roles and asset permissions.
+    Reads the RBAC index (or its shared snapshot) when it knows the user, otherwise runs a single joined query.
+    """
+    indexed = authz_index.user_roles(username)
+    if indexed is not None:
+        user_id, role_ids, role_names = indexed
+        return {"user_id": user_id, "role_ids": role_ids, "role_names": role_names,
+                "asset_masks": authz_index.asset_masks(role_ids), "version": authz_index.user_version(user_id)}
+    logging.info("Fetching user, role and permission data from db.")
+    rows = (await db.execute(
+        select(Users.user_id, Roles.role_id, Roles.role_name, Assets.asset_name, Permissions.permission_id,
+               Permissions.asset_id, Permissions.is_read, Permissions.is_create, Permissions.is_update,
+               Permissions.is_delete).
+        select_from(Users).
+        outerjoin(UserRoles, UserRoles.user_id == Users.user_id).
+        outerjoin(Roles, Roles.role_id == UserRoles.role_id).
+        outerjoin(RolePermissions, RolePermissions.role_id == Roles.role_id).
+        outerjoin(Permissions, Permissions.permission_id == RolePermissions.permission_id).
+        outerjoin(Assets, Assets.id == Permissions.asset_id).
+        filter(Users.username == username))).all()
+    if not rows:
+        return None
+    asset_masks = {}
+    for row in rows:
+        if row.permission_id is not None:
+            asset_name = row.asset_name or ANY_ASSET_NAME
+            asset_masks[asset_name] = asset_masks.get(asset_name, 0) | permission_mask(row)
+    return {
+        "user_id": rows[0].user_id,
+        "role_ids": frozenset(row.role_id for row in rows if row.role_id is not None),
+        "role_names": frozenset(row.role_name for row in rows if row.role_name is not None),
+        "asset_masks": asset_masks,
+        "version": authz_index.user_version(rows[0].user_id),
+    }
+
+
+def access_claims(user_access: dict) -> dict:
+    """Authorization claims to embed in the access token, so requests can be authorized without db.
+    Nothing is embedded while the RBAC index, which versions the claims, is not loaded.
+    """
+    if user_access["version"] is None:
+        return {}
+    return {
+        "uid": user_access["user_id"],
+        "roles": sorted(user_access["role_ids"]),
+        "perms": user_access["asset_masks"],
+        "ver": user_access["version"],
+    }
+
+
+def is_current(user_access: dict) -> bool:
+    """Return False if the user's roles changed after this access was resolved or issued."""
+    current_version = authz_index.user_version(user_access["user_id"])
+    if user_access["version"] is None or current_version is None:
+        return True
+    if current_version > user_access["version"]:
+        return False
+    # A role granted and removed again between two refreshes leaves no newer version behind.
+    return user_access["role_ids"] <= authz_index.user_role_ids(user_access["user_id"])
 
-    logging.info("Validating user permission.")
+
+def access_from_claims(decoded_token: dict) -> Union[dict, None]:
+    """Rebuild the user access from the token claims, or None if there are none or they are outdated."""
+    if decoded_token.get("ver") is None or decoded_token.get("uid") is None:
+        return None
+    role_ids = frozenset(decoded_token.get("roles", ()))
+    user_access = {
+        "user_id": decoded_token["uid"],
+        "role_ids": role_ids,
+        "role_names": authz_index.role_names(role_ids),
+        "asset_masks": decoded_token.get("perms", {}),
+        "version": decoded_token["ver"],
+    }
+    if authz_index.user_version(user_access["user_id"]) is None or not is_current(user_access):
+        logging.info("Token claims are outdated, resolving the user access again.")
+        return None
+    return user_access
+
+
+async def get_user_access(token: str, db) -> Union[dict, None]:
+    """Return the resolved access of the token's user or None if the token is not valid.
+    Access comes from the token claims while the user's roles are unchanged, otherwise from the
+    RBAC index or db. It is cached per token until the token expires or the user's roles change,
+    so repeated calls with the same token do not touch the db. Revoked tokens are not valid.
+    """
     if not token:
         logging.error("Token not found.")
-        return False
-    decoded_token = decode_access_token(token.replace("Bearer ", ""))
+        return None
+    token = token.replace("Bearer ", "")
+    user_access = auth_cache.get(token)
+    if user_access is not None and is_current(user_access):
+        if user_access["jti"] in revocations:
+            logging.error("Token has been revoked.")
+            return None
+        return user_access
+    decoded_token = decode_access_token(token)
     if not decoded_token:
         logging.error("Invalid token.")
-        return False
+        return None
+    if decoded_token.get("jti") in revocations:
+        logging.error("Token has been revoked.")
+        return None
     user = decoded_token.get('sub', None)
     if not user:
         logging.error("username not found in token.")
-        return False
+        return None
+    user_access = access_from_claims(decoded_token) or await load_user_access(user, db)
+    if user_access is None:
+        logging.error("User not found.")
+        return None
+    # The token id is kept with the cached access, so cache hits are checked for revocation too.
+    user_access = {**user_access, "jti": decoded_token.get("jti")}
+    auth_cache.set(token, user, decoded_token["exp"], user_access)
+    return user_access
 
-    logging.info("Fetching user and role data from db.")
-    user_obj = db.query(Users).filter(Users.username == user).first()
-    user_role = db.query(UserRoles).filter(UserRoles.user_id == user_obj.user_id)
+
+async def get_permission(token: str, role: str, db) -> bool:
+    """This function will return True if the user is permitted."""
+    started = time.perf_counter()
+    try:
+        return await _get_permission(token, role, db)
+    finally:
+        authorization_seconds.observe(time.perf_counter() - started, role)
+
+
+async def _get_permission(token: str, role: str, db) -> bool:
+    logging.info("Validating user permission.")
+    user_access = await get_user_access(token, db)
+    if user_access is None:
+        return False
 
     # Return True for the Admin user.
-    if user_role and user_role.first() and user_role.first().role_id == 1:
+    if ADMIN_ROLE_ID in user_access["role_ids"]:
         logging.info("User is an admin user.")
         return True
 
     logging.info("Checking user's role.")
-    role_obj = db.query(Roles).filter(Roles.role_name == role).first()
-    user_role = user_role.filter(UserRoles.role_id == role_obj.role_id).first()
+    return role in user_access["role_names"]
 
-    return bool(user_role)
+
+def check_access(user_access: dict, asset: str, action: str) -> bool:
+    """Return True if the resolved user access allows the action on the asset."""
+    if ADMIN_ROLE_ID in user_access["role_ids"]:
+        return True
+    return has_action(user_access["asset_masks"], asset, action)